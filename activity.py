@@ -0,0 +1,90 @@
+from models import db, User
+from sqlalchemy import bindparam
+import atexit
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# seconds between writes, and how many users may be waiting before a write
+# is made early
+FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5))
+FLUSH_SIZE = 200
+COLUMNS = ("last_login", "last_api_access")
+
+
+class ActivityTracker(object):
+    # remembers when users were last seen and writes it back in batches, so
+    # a page view costs a dict update instead of an UPDATE. timestamps only
+    # move forward, so several processes can flush without coordinating
+
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE):
+        self.interval = interval
+        self.size = size
+        self._lock = threading.Lock()
+        self._pending = {column: {} for column in COLUMNS}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def touch(self, user_id, column, when=None):
+        # records that a user was seen. `column` is one of COLUMNS
+        when = int(when or time.time())
+        with self._lock:
+            pending = self._pending[column]
+            if pending.get(user_id, 0) < when:
+                pending[user_id] = when
+            count = sum(len(p) for p in self._pending.values())
+        if count >= self.size:
+            self._wake.set()
+
+    def flush(self):
+        # writes everything buffered so far. needs an app context
+        with self._lock:
+            batches = self._pending
+            self._pending = {column: {} for column in COLUMNS}
+        written = 0
+        for column, seen in batches.items():
+            if not seen:
+                continue
+            col = getattr(User, column)
+            statement = User.__table__.update().where(
+                User.id == bindparam("user_id")).where(
+                db.or_(col.is_(None), col < bindparam("seen"))).values(
+                {column: bindparam("seen")})
+            db.session.execute(statement, [{"user_id": user_id, "seen": when}
+                                           for user_id, when in seen.items()])
+            written += len(seen)
+        if written:
+            db.session.commit()
+        return written
+
+    def run(self, app):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self._flush_in(app)
+
+    def _flush_in(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                log.exception("couldn't write user activity")
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def start(self, app):
+        # starts the background writer for this process, and writes whatever
+        # is left when the process exits
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self.run, args=(app,),
+                                        name="activity-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_in, app)
+
+
+tracker = ActivityTracker()
@@ -1,17 +1,69 @@
-from flask import Blueprint, g, jsonify, redirect, request, Response
+from flask import (Blueprint, g, jsonify, redirect, request, Response,
+                   send_from_directory, stream_with_context, url_for)
 from utils import age_to_words, bad_request
-from decorators import mod_required, api_disallowed
-from reddit import send_message, route
-from sqlalchemy.exc import IntegrityError
+from decorators import mod_required, api_disallowed, read_only
+from reddit import client, route, RedditError
+from jobs import LEASE, backoff, enqueue_message
 from sqlalchemy import func, inspect
-from models import User
+from models import User, Settings, Archive, Job
 from models import db
+from cache import cached_page, settings_cache
+import apikeys
+import counters
+import metrics
+import profiling
+import querylog
+import purge
+from schema import publish
+from formatting import TEMPLATES, TemplateError, compile_template
 from werkzeug.exceptions import HTTPException
-import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import csv
+import io
+import os
 import json
-import string
+import logging
+import time
 
 api = Blueprint('api', __name__, template_folder='templates')
+log = logging.getLogger(__name__)
+
+# most submissions /api/process will claim in one call
+MAX_BATCH = 100
+# delivery attempts before a submission is marked failed and set aside
+MAX_PROCESS_ATTEMPTS = 5
+# reddit calls made at once while processing a batch
+PROCESS_CONCURRENCY = int(os.environ.get("PROCESS_CONCURRENCY", 4))
+# seconds of reddit calls one /api/process request may plan for; a batch is
+# cut down to what the rate limiter allows in that time
+PROCESS_TIME_LIMIT = int(os.environ.get("PROCESS_TIME_LIMIT", 20))
+
+# fields written by /api/export, in order
+EXPORT_COLUMNS = ["id", "username", "submitted", "processed", "post_karma",
+                  "comment_karma", "created_utc", "is_mod", "verified_email",
+                  "response_title", "full_body_md", "question_set_id",
+                  "response", "process_attempts", "process_failed",
+                  "process_error"]
+EXPORT_FILTERS = {
+    "all": [],
+    "submitted": [User.submitted == True],  # noqa: E712
+    "pending": [User.submitted == True, User.processed == False],  # noqa: E712
+    "processed": [User.submitted == True, User.processed == True],  # noqa: E712
+    "failed": [User.submitted == True, User.processed == False,  # noqa: E712
+               User.process_failed == True],  # noqa: E712
+    "unsubmitted": [User.submitted == False],  # noqa: E712
+}
+# rows fetched from the database per round trip
+EXPORT_CHUNK = 1000
+
+# Settings columns that can't be modified in the settings menu
+SETTINGS_HIDDEN = ["id", "questions", "question_set_id", "version",
+                   "response_body", "min_age_word"]
+# (attribute, output key) for every column /api/settings reports, read
+# from the model once rather than reflected from the database per call
+SETTINGS_FIELDS = [(attr.key, attr.columns[0].name.lower())
+                   for attr in inspect(Settings).column_attrs
+                   if attr.columns[0].name.lower() not in SETTINGS_HIDDEN]
 
 
 @api.route('/questions', methods=['POST'])
@@ -25,10 +77,8 @@ def questions():
     dirty_data = request.get_json(force=True)
     sanitized = []
     max_num = None
-    ids = 0
     for d in dirty_data:
         out = {}
-        out_ids = 1
         out["text"] = d["text"]
 
         # type validation
@@ -59,7 +109,6 @@ def questions():
                 out_data.append(str(item))
             if len(out_data) > 0:
                 out["data"] = out_data
-                out_ids += len(out_data)
 
         # add validators
         if "validators" in d.keys() and len(d["validators"].keys()) > 0:
@@ -96,7 +145,6 @@ def questions():
                             int):
                         out_validators[validator] = current
             out["validators"] = out_validators
-        ids += out_ids
         sanitized.append(out)
 
     # set priority of items that aren't prioritized yet
@@ -111,43 +159,47 @@ def questions():
     # sort questions, and save data
     newlist = sorted(sanitized, key=lambda k: k['priority'])
     sanitized_json = json.dumps(newlist)
-    g.settings.questions = sanitized_json
-    g.settings.required_ids = ids
-    db.session.add(g.settings)
+    s = Settings.query.get(g.settings.id)
+    publish(s, sanitized_json)
+    settings_cache.bump(s)
+    db.session.add(s)
     db.session.commit()
+    settings_cache.invalidate()
     return jsonify(status="OK"), 200
 
 
 @api.route('/queue')
 @mod_required
+@read_only
 def queue():
     # returns number of applications remaining
-    res = User.query.filter_by(processed=False).count()
+    counter = counters.get()
+    res = counter.pending
     return jsonify(
-        text=f"There are currently {res} item(s) in the queue.", number=res), 200
+        text=f"There are currently {res} item(s) in the queue.", number=res,
+        unsubmitted=counter.unsubmitted, processed=counter.processed,
+        failed=counter.failed), 200
+
+
+@api.route('/queue/reconcile')
+@mod_required
+def queue_reconcile():
+    # recounts the queue counters from the User table
+    counter = counters.reconcile()
+    return jsonify(unsubmitted=counter.unsubmitted, number=counter.pending,
+                   processed=counter.processed, failed=counter.failed), 200
 
 
 @api.route('/issue_key')
 @mod_required
 @api_disallowed
 def issue_key():
-    # issue api token
-    run = True
-    while run:
-        # issue key
-        key = "".join(
-            random.choices(
-                string.ascii_letters +
-                string.digits,
-                k=32))
-        g.user.api_key = key
-        try:
-            db.session.add(g.user)
-            db.session.commit()
-            run = False
-        except IntegrityError:  # check for uniqueness
-            continue
-    return g.user.api_key
+    # issue api token. it's only stored hashed, so this is the one time
+    # it's shown
+    key = apikeys.issue(g.user)
+    db.session.add(g.user)
+    db.session.commit()
+    return key
 
 
 @api.route('/update_setting', methods=['POST'])
@@ -162,38 +214,34 @@ def update_setting():
         data = False
     if setting_name.lower() not in g.settings.__dict__.keys():
         return bad_request(f"setting field {setting_name} does not exist")
+    if setting_name in TEMPLATES:
+        # catch bad placeholders now rather than when someone submits
+        try:
+            compile_template(setting_name, data)
+        except TemplateError as e:
+            return bad_request(str(e))
+    s = Settings.query.get(g.settings.id)
     if setting_name == 'min_age' and data is not None:
         age = age_to_words(int(data))
-        setattr(g.settings, 'min_age_word', age)
-    setattr(g.settings, setting_name, data)
-    db.session.add(g.settings)
+        setattr(s, 'min_age_word', age)
+    setattr(s, setting_name, data)
+    settings_cache.bump(s)
+    db.session.add(s)
     db.session.commit()
+    settings_cache.invalidate()
     return jsonify(status="OK"), 200
 
 
 @api.route('/settings')
 @mod_required
+@cached_page(lambda: "mod")
 def settings():
-    # returns data about the current settings
-    i = inspect(db.engine)
-    cols = i.get_columns("Settings")
-    ignore = [
-        'id',
-        'questions',
-        'required_ids',
-        'response_body',
-        'min_age_word']
+    # returns data about the current settings. the rendered output is kept
+    # per settings version by cached_page
     out = {}
-    for col in cols:
-        # don't include things that can't be modified in the settings menu
-        if col["name"].lower() in ignore:
-            continue
-
-        col_dict = {}
-        col_dict["value"] = getattr(g.settings, col["name"])
-        col_dict["type"] = type(col_dict["value"]).__name__
-        out[col["name"].lower()] = col_dict
-
+    for attr, name in SETTINGS_FIELDS:
+        value = getattr(g.settings, attr)
+        out[name] = {"value": value, "type": type(value).__name__}
     return Response(json.dumps(out), mimetype="application/json")
 
 
@@ -205,12 +253,10 @@ def add_exemption():
     username = request.form["username"]
     if not username:
         return bad_request("username not provided")
-    user = User.query.filter(func.lower(username) ==
+    user = User.query.filter(func.lower(User.username) ==
                              func.lower(username)).first()
     if user:
         user.is_exempt = True
-        if len(user.response) > 0:
-            user.response = ""
         db.session.add(user)
         db.session.commit()
         return jsonify(status="OK"), 200
@@ -221,15 +267,39 @@ def add_exemption():
 @api.route('/clear')
 @mod_required
 def clear():
-    # deletes DB rows to make more room
-
+    # deletes DB rows to make more room. rows are archived first, and the
+    # work is done by a background job in chunks; poll /api/clear/<job> for
+    # progress. while a purge is queued or running, its id is returned instead
     data = request.get_json(force=True)
-    if "all" in data.keys() and data["all"] is True:
-        db.session.query(User).delete()
-    else:
-        User.query.filter_by(processed=True).delete()
+    scope = "all" if data.get("all") is True else "processed"
+    job = purge.start(scope)
     db.session.commit()
-    return jsonify(status="OK"), 200
+    return jsonify(status="OK", job=job.id), 200
+
+
+@api.route('/clear/<int:job_id>')
+@mod_required
+def clear_status(job_id):
+    # reports how far a purge has got
+    job = Job.query.get(job_id)
+    if job is None or job.kind != "purge":
+        return bad_request("purge not found")
+    return jsonify(purge.progress(job)), 200
+
+
+@api.route('/archive')
+@mod_required
+@read_only
+def archive():
+    # returns archived (cleared) rows for a username
+    username = request.args.get('username', '')
+    rows = Archive.query.filter_by(username=username).order_by(Archive.id)
+    out = []
+    for row in rows:
+        record = json.loads(purge.decompress(row.codec, row.data).decode())
+        out.append({"archived": row.archived, "purge": row.job_id,
+                    "user": record})
+    return jsonify(archived=out), 200
 
 
 @api.route('/add_mod', methods=["POST"])
@@ -242,28 +312,16 @@ def add_mod():
     if not user:
         return bad_request("user not found")
     user.form_mod = True
-    run = True
-    while run:
-        # issue key
-        key = "".join(
-            random.choices(
-                string.ascii_letters +
-                string.digits,
-                k=32))
-        user.api_key = key
-        try:
-            db.session.add(user)
-            db.session.commit()
-            run = False
-        except IntegrityError:  # check for uniqueness
-            continue
-    db.session.add(user)
-    db.session.commit()
-    url = url_for('settings', _external=True)
+    # any key left over from an earlier stint is replaced; the new mod
+    # issues their own from the API page
+    apikeys.issue(user)
+    url = url_for('mod.settings', _external=True)
     subj = f"invitation to moderate {g.settings.site_title}"
     body = f"**gadzooks!** u/{g.user.username} has added you as a moderator of {g.settings.site_title}"
     body += f"\n\nclick [here]({url}) to view the site. mod tools will be visible at the top of the page."
-    send_message(username, subj, body)
+    enqueue_message(username, subj, body)
+    db.session.add(user)
+    db.session.commit()
     return jsonify(status="OK"), 200
 
 
@@ -277,6 +335,7 @@ def remove_mod():
     if not user:
         return bad_request("user not found")
     user.form_mod = False
+    apikeys.revoke(user)
     db.session.add(user)
     db.session.commit()
     return jsonify(status="OK"), 200
@@ -285,22 +344,210 @@ def remove_mod():
 @api.route('/process')
 @mod_required
 def process():
-    count = User.query.filter_by(
-        submitted=True).filter_by(
-        processed=False).count()
-    if count == 0:
-        return jsonify(text="0 unprocessed form submissions remaining")
-    user = User.query.filter_by(
-        submitted=True).filter_by(
-        processed=False).first()
-    body = user.full_body_md
-    title = user.response_title
+    # delivers unprocessed form submissions. ?batch=N claims up to N rows at
+    # once, fewer if reddit's rate limit wouldn't allow that many soon; rows
+    # claimed by another caller are skipped, so several mods or bots can
+    # drain the queue together without double-posting. a failed
+    # delivery is retried later, behind fresh submissions, and given up on
+    # after MAX_PROCESS_ATTEMPTS.
+    try:
+        batch = int(request.args.get('batch', 1))
+    except ValueError:
+        return bad_request("batch must be a number")
+    budget = client.limiter.budget()
+    affordable = int(budget["tokens"] +
+                     budget["rate_per_minute"] / 60 * PROCESS_TIME_LIMIT)
+    batch = max(1, min(batch, MAX_BATCH, affordable))
+    now = int(time.time())
+    users = User.query.filter(
+        User.submitted == True,  # noqa: E712
+        User.processed == False,  # noqa: E712
+        User.process_failed == False,  # noqa: E712
+        db.or_(User.process_after.is_(None), User.process_after <= now)
+    ).order_by(User.process_attempts, User.id).limit(batch).with_for_update(
+        skip_locked=True).all()
+    if not users:
+        db.session.commit()
+        return jsonify(text="0 unprocessed form submissions remaining",
+                       results=[])
+
     destination = g.settings.destination_id
-    route(title, body, destination)
-    user.processed = True
-    db.session.add(user)
+    items = [(u.id, u.response_title, u.full_body_md) for u in users]
+    # lease the rows and let go of the locks before calling reddit. other
+    # callers skip them until the lease runs out, and each row is committed
+    # as soon as its delivery finishes
+    for user in users:
+        user.process_after = now + LEASE
     db.session.commit()
-    return jsonify(text=f"{count-1} unprocessed form submissions remaining")
+
+    def deliver(item):
+        user_id, title, body = item
+        try:
+            return user_id, route(title, body, destination), None
+        except (RedditError, ValueError) as e:
+            return user_id, None, str(e)
+        except Exception as e:
+            # anything else is a bug, but it mustn't take down the batch:
+            # the other rows may already be posted and would be re-sent
+            log.exception("delivering submission %s failed", user_id)
+            return user_id, None, f"{type(e).__name__}: {e}"
+
+    by_id = {u.id: u for u in users}
+    results = {}
+    workers = min(len(items), PROCESS_CONCURRENCY)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(deliver, item) for item in items]
+        for future in as_completed(futures):
+            user_id, url, error = future.result()
+            user = by_id[user_id]
+            if error is None:
+                user.processed = True
+                user.process_error = None
+                user.process_after = None
+                counters.move("pending", "processed")
+                results[user_id] = {"id": user_id, "username": user.username,
+                                    "status": "delivered", "url": url}
+            else:
+                user.process_attempts = (user.process_attempts or 0) + 1
+                user.process_error = error
+                if user.process_attempts >= MAX_PROCESS_ATTEMPTS:
+                    user.process_failed = True
+                    user.process_after = None
+                    counters.move("pending", "failed")
+                    status = "failed"
+                else:
+                    user.process_after = int(time.time()) + backoff(
+                        user.process_attempts)
+                    status = "retrying"
+                results[user_id] = {"id": user_id, "username": user.username,
+                                    "status": status, "error": error,
+                                    "attempts": user.process_attempts}
+            db.session.add(user)
+            db.session.commit()
+
+    count = counters.get().pending
+    return jsonify(text=f"{count} unprocessed form submissions remaining",
+                   results=[results[user_id] for user_id, _, _ in items])
+
+
+@api.route('/export')
+@mod_required
+@read_only
+def export():
+    # streams submissions as NDJSON (default) or CSV. rows are read through a
+    # server-side cursor in chunks, so memory use doesn't grow with the table
+    fmt = request.args.get('format', 'ndjson').lower()
+    if fmt not in ["ndjson", "csv"]:
+        return bad_request("format must be ndjson or csv")
+    status = request.args.get('status', 'submitted').lower()
+    if status not in EXPORT_FILTERS:
+        return bad_request(
+            f"status must be one of {', '.join(EXPORT_FILTERS.keys())}")
+
+    columns = [getattr(User, name) for name in EXPORT_COLUMNS]
+    query = db.session.query(*columns).filter(*EXPORT_FILTERS[status])
+    min_id = request.args.get('min_id', type=int)
+    max_id = request.args.get('max_id', type=int)
+    if min_id is not None:
+        query = query.filter(User.id >= min_id)
+    if max_id is not None:
+        query = query.filter(User.id <= max_id)
+    query = query.order_by(User.id).execution_options(
+        stream_results=True).yield_per(EXPORT_CHUNK)
+
+    def generate_ndjson():
+        for row in query:
+            yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n"
+
+    def generate_csv():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(EXPORT_COLUMNS)
+        for i, row in enumerate(query, 1):
+            writer.writerow(row)
+            if i % EXPORT_CHUNK == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    if fmt == "csv":
+        body, mimetype = generate_csv(), "text/csv"
+    else:
+        body, mimetype = generate_ndjson(), "application/x-ndjson"
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = \
+        f"attachment; filename=submissions-{status}.{fmt}"
+    return response
+
+
+@api.route('/ratelimit')
+@mod_required
+def ratelimit():
+    # shows how much of reddit's rate limit this process has left
+    return jsonify(client.limiter.budget()), 200
+
+
+@api.route('/metrics')
+@mod_required
+def metrics_text():
+    # this process's request, query and reddit call metrics, in the
+    # prometheus text format
+    return Response(metrics.render(),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@api.route('/slow_queries')
+@mod_required
+def slow_queries():
+    # recent statements slower than SLOW_QUERY_MS, with their query plans,
+    # and requests that made more than QUERY_LIMIT queries. newest first
+    return jsonify(slow=list(reversed(querylog.slow_queries)),
+                   busy=list(reversed(querylog.busy_requests)),
+                   slow_query_ms=querylog.SLOW_QUERY_MS,
+                   query_limit=querylog.QUERY_LIMIT), 200
+
+
+@api.route('/profiles')
+@mod_required
+def profiles():
+    # lists the sampled profiles saved by this host, newest first
+    return jsonify(profiles=profiling.saved_profiles()), 200
+
+
+@api.route('/profiles/<name>')
+@mod_required
+def profile(name):
+    # downloads a saved profile, for pstats, snakeviz and the like
+    if name not in profiling.saved_profiles():
+        return bad_request("profile not found")
+    return send_from_directory(profiling.PROFILE_DIR, name,
+                               as_attachment=True)
+
+
+@api.route('/jobs')
+@mod_required
+@read_only
+def jobs():
+    # lists outbound jobs, newest first. ?status=failed shows deliveries
+    # that gave up
+    status = request.args.get('status')
+    limit = min(int(request.args.get('limit', 50)), 500)
+    query = Job.query
+    if status:
+        query = query.filter_by(status=status)
+    out = []
+    for job in query.order_by(Job.id.desc()).limit(limit):
+        out.append({"id": job.id,
+                    "kind": job.kind,
+                    "status": job.status,
+                    "attempts": job.attempts,
+                    "payload": json.loads(job.payload),
+                    "last_error": job.last_error,
+                    "created": job.created,
+                    "updated": job.updated})
+    return jsonify(jobs=out), 200
+
 
 @api.errorhandler(Exception)
 def handle_error(e):
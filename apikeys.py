@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from flask import current_app
+from models import db, User
+import hashlib
+import hmac
+import os
+import secrets
+import string
+import threading
+import time
+
+# characters of a key stored in the clear so it can be found by index
+PREFIX_LENGTH = 8
+KEY_LENGTH = 32
+# how long a worker trusts a verified key before checking it again. edits
+# made through another worker (a reissued key, a removed mod) can take
+# this long to be seen here
+CACHE_TTL = int(os.environ.get("API_KEY_CACHE_TTL", 60))
+CACHE_SIZE = 256
+
+
+def hash_key(key):
+    secret = (current_app.secret_key or "").encode()
+    return hmac.new(secret, key.encode(), hashlib.sha256).hexdigest()
+
+
+class KeyCache(object):
+    # verified keys, by hash, with a detached copy of the user they belong
+    # to. bounded by size and age
+
+    def __init__(self, ttl=CACHE_TTL, maxsize=CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._users.get(digest)
+            if entry is None:
+                return None
+            user, expires = entry
+            if time.monotonic() >= expires:
+                del self._users[digest]
+                return None
+            self._users.move_to_end(digest)
+            return user
+
+    def put(self, digest, user):
+        with self._lock:
+            self._users[digest] = (user, time.monotonic() + self.ttl)
+            self._users.move_to_end(digest)
+            while len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    def evict(self, user_id):
+        with self._lock:
+            for digest in [d for d, (u, _) in self._users.items()
+                           if u.id == user_id]:
+                del self._users[digest]
+
+
+key_cache = KeyCache()
+
+
+def authenticate(key):
+    # returns the user an api key belongs to, or None. a recently verified
+    # key is answered from memory without touching the database
+    if not key or len(key) < PREFIX_LENGTH:
+        return None
+    digest = hash_key(key)
+    cached = key_cache.get(digest)
+    if cached is not None:
+        # a copy for this request's session; load=False skips the SELECT
+        return db.session.merge(cached, load=False)
+    candidates = User.query.filter_by(
+        api_key_prefix=key[:PREFIX_LENGTH]).all()
+    for user in candidates:
+        if user.api_key_hash and hmac.compare_digest(user.api_key_hash,
+                                                     digest):
+            break
+    else:
+        return None
+    db.session.expunge(user)
+    key_cache.put(digest, user)
+    return db.session.merge(user, load=False)
+
+
+def issue(user):
+    # gives a user a new api key, replacing any old one, and returns it.
+    # only the hash is kept, so this is the one time the key can be shown
+    allowed = string.ascii_letters + string.digits
+    key = "".join(secrets.choice(allowed) for _ in range(KEY_LENGTH))
+    user.api_key = None
+    user.api_key_hash = hash_key(key)
+    user.api_key_prefix = key[:PREFIX_LENGTH]
+    key_cache.evict(user.id)
+    return key
+
+
+def revoke(user):
+    user.api_key = None
+    user.api_key_hash = None
+    user.api_key_prefix = None
+    key_cache.evict(user.id)
+
+
+def hash_plaintext_keys():
+    # replaces keys stored in the clear (from before they were hashed) with
+    # their hashes. the keys themselves keep working
+    users = User.query.filter(User.api_key.isnot(None)).all()
+    for user in users:
+        user.api_key_hash = hash_key(user.api_key)
+        user.api_key_prefix = user.api_key[:PREFIX_LENGTH]
+        user.api_key = None
+        db.session.add(user)
+    if users:
+        db.session.commit()
@@ -1,19 +1,26 @@
-from flask import (Flask, abort, g, jsonify, redirect,
+from flask import (Flask, abort, g, has_request_context, jsonify, redirect,
                    render_template, request, session, url_for)
-from models import db, User, Settings
-from sqlalchemy.exc import IntegrityError
+from models import db, User, Settings, REPLICA
+from cache import cached_page, settings_cache
+from schema import get_schema, publish
+from validation import parse_and_validate
+from formatting import get_templates, render_context
+from migrate import upgrade
+import activity
+import apikeys
+import counters
+import metrics
+import querylog
 from flask_sslify import SSLify
 from decorators import login_required, mod_required, api_disallowed
 from werkzeug.exceptions import HTTPException
-from reddit import generate_oauth_url, send_message, route, verify_identity
-from utils import age_to_words, bad_request
+from reddit import generate_oauth_url, verify_identity
+from jobs import enqueue_message, start_worker
+from utils import bad_request
 import json
 import os
 import uuid
 import time
-import random
-import string
-import markdown
 
 app = Flask(__name__)
 
@@ -25,7 +32,14 @@ sslify = SSLify(app)
 
 # SQLAlchemy intiialization
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
+if os.environ.get('DATABASE_REPLICA_URL'):
+    # read-only mod views and api endpoints query this instead
+    app.config['SQLALCHEMY_BINDS'] = {
+        REPLICA: os.environ.get('DATABASE_REPLICA_URL')}
 db.init_app(app)
+# time every request, including the hooks below
+metrics.init_app(app)
+querylog.init_app(app)
 
 # import/register blueprints
 from api import api
@@ -37,55 +51,79 @@ app.register_blueprint(mod, url_prefix='/mod')
 @app.before_first_request
 def startup():
     db.create_all()
+    upgrade()
     # create settings object if it doesn't exist
     settings = Settings.query.first()
     if not settings:
         s = Settings()
         # load example questions json
         with open("data/question_example.json", "r") as example:
-            s.questions = example.read()
-        # detect number of response IDs required
-        data = json.loads(s.questions)
-        ids = len(data)
-        for d in data:
-            if "data" in d.keys():
-                ids += len(d["data"])
-        s.required_ids = ids
+            publish(s, example.read())
         # set example response text
         with open("data/response_example.txt", "r") as resp:
             s.response_body = resp.read()
         db.session.add(s)
         db.session.commit()
+    elif settings.question_set_id is None:
+        # databases from before question sets were versioned
+        publish(settings, settings.questions)
+        settings_cache.bump(settings)
+        db.session.add(settings)
+        db.session.commit()
+    apikeys.hash_plaintext_keys()
+    if counters.get() is None:
+        counters.reconcile()
+    counters.schedule_reconcile()
+    start_worker(app)
+    activity.tracker.start(app)
+
+
+class RequestGlobals(app.app_ctx_globals_class):
+    # g, except that the current user is only looked up the first time
+    # something (a view, a decorator, a template) asks for g.user or
+    # g.api_login. anonymous pages never touch the User table.
+
+    def __getattr__(self, name):
+        if name in ("user", "api_login"):
+            self._load_user()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+    def _load_user(self):
+        self.user = None
+        self.api_login = False
+        if not has_request_context():
+            return
+        user_id = session.get('user_id')
+        if user_id is not None:
+            self.user = User.query.get(user_id)
+        elif 'username' in session:
+            # logged in before sessions carried the user id
+            self.user = User.query.filter_by(
+                username=session['username']).first()
+            if self.user:
+                session['user_id'] = self.user.id
+        if not self.user:
+            self.user = None
+            api_key = request.headers.get('X-Api-Key', None)
+            if not api_key:
+                api_key = request.args.get('key', None)
+            if api_key:
+                self.user = apikeys.authenticate(api_key)
+                self.api_login = True
+        if self.user and not self.api_login:
+            activity.tracker.touch(self.user.id, "last_login")
+        elif self.user and self.api_login:
+            activity.tracker.touch(self.user.id, "last_api_access")
+
+
+app.app_ctx_globals_class = RequestGlobals
 
 
 @app.before_request
 def load_g():
-    # load globals
-    s = Settings.query.first()
-    g.settings = s
-    try:
-        username = session['username']
-    except KeyError:
-        username = None
-    g.api_login = False
-    user = User.query.filter_by(username=username).first()
-    if user:
-        g.user = user
-    else:
-        g.user = None
-    try:
-        api_key = request.headers.get('X-Api-Key', None)
-        if not api_key:
-            api_key = request.args.get('key', None)
-        if api_key and not g.user:
-            g.user = User.query.filter_by(api_key=api_key).first()
-            g.api_login = True
-    except KeyError:
-        g.api_key = None
-    if g.user and not g.api_login:
-        g.last_login = int(time.time())
-    elif g.user and g.api_login:
-        g.last_api_access = int(time.time())
+    # load globals. the user is loaded lazily by RequestGlobals
+    g.settings = settings_cache.get()
 
 
 @app.route('/')
@@ -141,21 +179,11 @@ def callback():
             verified_email=user_dict['has_verified_email'])
         # make the first created account a form moderator
         db.session.add(u)
+        counters.add("unsubmitted")
         db.session.commit()
         if u.id == 1:
             u.form_mod = True
-            run = True
-            while run:
-                # issue key
-                allowed = string.ascii_letters + string.digits
-                key = "".join(random.choices(allowed, k=32))
-                u.api_key = key
-                try:
-                    db.session.add(u)
-                    db.session.commit()
-                    run = False
-                except IntegrityError:  # check for uniqueness
-                    continue
+            apikeys.issue(u)
 
     else:
         u.post_karma = user_dict['link_karma']
@@ -165,6 +193,7 @@ def callback():
         u.verified_email = user_dict['has_verified_email']
     db.session.add(u)
     db.session.commit()
+    session['user_id'] = u.id
     return redirect(url_for(state_params[1]))
 
 
@@ -197,273 +226,85 @@ def form():
     if issues:
         return render_template('issue.html', errors=issues)
 
-    # render form
+    # render form. field ids are derived from the user and question set,
+    # so nothing is stored until the form is submitted
     if request.method == 'GET':
-        # load form if data was already copied
-        try:
-            json_data = json.loads(g.user.response)
-            return render_template("form.html", data=json_data)
-        except (TypeError, ValueError):
-            pass
-
-        ids = []
-        copy = json.loads(g.settings.questions)
-        while len(ids) < g.settings.required_ids:
-            s = ''.join(
-                random.choices(
-                    string.ascii_letters +
-                    string.digits,
-                    k=4))
-            if s not in ids:
-                ids.append(s)
-
-        for q in copy:
-            q["id"] = ids.pop()
-            if "data" in q.keys():
-                # add ids to data
-                new_data = []
-                for d in q["data"]:
-                    new_data.append([ids.pop(), d])
-                q["data"] = new_data
-
-            # generate validator descriptions
-            if "validators" in q.keys():
-                validators = q["validators"]
-                validator_words = []
-                for validator in validators.keys():
-                    q_type = q["type"].lower()
-                    if validator.lower() == "min":
-                        if q_type in ["text", "textarea"]:
-                            phrase = "Must be longer than {} characters".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                        elif q_type in ["number"]:
-                            phrase = "Number must be bigger than {}.".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                        elif q_type in ["checkbox"]:
-                            phrase = "At least {} need to be selected".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                    elif validator.lower() == "max":
-                        if q_type in ["text", "textarea"]:
-                            phrase = "Must be shorter than {} characters".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                        elif q_type in ["number"]:
-                            phrase = "Number must be smaller than {}.".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                        elif q_type in ["checkbox"]:
-                            phrase = "No more than {} may be selected".format(
-                                validators[validator])
-                            validator_words.append(phrase)
-                    elif validator.lower() == "required":
-                        phrase = "Requires a response."
-                        validator_words.append(phrase)
-                if len(validator_words) > 0:
-                    q["validator_words"] = validator_words
-            q["response"] = ""
-
-        g.user.response = json.dumps(copy)
-        db.session.add(g.user)
-        db.session.commit()
-        return render_template("form.html", data=copy)
-
-    # process form data
-    template = json.loads(g.user.response)
-    has_error = False
-    for question in template:
-        # clear errors
-        if "error" in question.keys():
-            del question["error"]
-
-        # parse input based on question type
-        q_type = question["type"]
-        if q_type in ["text", "textarea", "dropdown"]:
-            resp = request.form.get(question["id"])
-        elif q_type == "radio":
-            resp = []
-            resp_id = request.form.get(question["id"])
-            for option in question["data"]:
-                if option[0] == resp_id:
-                    resp = option[1]
-                    break
-        elif q_type == "number":
-            resp = int(request.form.get(question["id"]))
-        elif q_type == "checkbox":
-            resp = request.form.getlist(question["id"])
-            data = question["data"]
-            out_data = []
-            for response in resp:
-                for d in data:
-                    if response == d[0]:
-                        out_data.append(d[1])
-            resp = out_data
-
-        question["response"] = resp
-        # validate input
-        if "validators" in question.keys():
-            validators = question["validators"]
-
-            # minimum length validator
-            if "min" in validators.keys():
-                min_len = validators["min"]
-                if q_type in [
-                    "text",
-                    "textarea",
-                        "radio"] and len(resp) < min_len:
-                    msg = f"Response was too short. Minimum length is {min_len} characters."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-                elif q_type == "number" and resp < min_len:
-                    msg = f"Response was too small. Number must be greater than {min_len}."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-                elif q_type == "checkbox" and len(resp) < min_len:
-                    msg = f"Response was too short. At least {min_len} checkboxes must be checked."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-
-            # max length validator
-            if "max" in validators.keys():
-                max_len = validators["max"]
-                if q_type in [
-                    "text",
-                    "textarea",
-                        "radio"] and len(resp) > max_len:
-                    msg = f"Response was too long. Maximum length is {max_len} characters."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-                elif q_type == "number" and resp > max_len:
-                    msg = f"Response was too large. Number must be smaller than {max_len}."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-                elif q_type == "checkbox" and len(resp) > max_len:
-                    msg = f"Response was too long. No more than {min_len} checkboxes may be checked."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
-
-            # required validator
-            if "required" in question["validators"]:
-                unfilled = False
-                if q_type in [
-                    "text",
-                    "textarea",
-                    "radio",
-                        "checkbox"] and len(resp) == 0:
-                    unfilled = True
-                if resp is None or unfilled:
-                    msg = "A reply to this question is required."
-                    if "error" not in question.keys():
-                        question["error"] = [msg]
-                        has_error = True
-                    else:
-                        question["error"].append(msg)
+        schema = get_schema(g.settings.question_set_id)
+        data = schema.render(schema.ids_for(g.user.id))
+        return render_template("form.html", data=data,
+                               question_set=schema.version)
+
+    # process form data against the questions this user was shown. only the
+    # live question set is accepted, so an old form (or an edited hidden
+    # field) can't be answered against retired, looser questions
+    try:
+        question_set = int(request.form.get("question_set"))
+    except (TypeError, ValueError):
+        return redirect(url_for('form'))
+    if question_set != g.settings.question_set_id:
+        return redirect(url_for('form'))
+    schema = get_schema(question_set)
+
+    raw = schema.decode(g.user.id, request.form.lists())
+    answers, errors = parse_and_validate(schema, raw)
 
     # return errors for user to fix
-    if has_error:
-        return render_template("form.html", data=template, settings=g.settings)
+    if errors:
+        data = schema.render(schema.ids_for(g.user.id), answers, errors)
+        return render_template("form.html", data=data, settings=g.settings,
+                               question_set=schema.version)
 
     # save data and mark for processing
-    g.user.response = json.dumps(template)
+    g.user.question_set_id = schema.version
+    g.user.response = json.dumps(answers)
     out = ""
     counter = 1
-    for question in template:
-        out += f"\n**{counter}. {question['text']}**\n\n"
-        if not isinstance(question['response'], (list, tuple)):
+    for q, response in zip(schema.questions, schema.responses(answers)):
+        out += f"\n**{counter}. {q.text}**\n\n"
+        if not isinstance(response, (list, tuple)):
+            if response is None:
+                response = ""
             out += "\n\n".join("> " +
-                               line for line in str(question['response']).splitlines())
+                                line for line in str(response).splitlines())
         else:
-            out += "\n".join(">* " + line for line in question['response'])
+            out += "\n".join(">* " + line for line in response)
         out += "\n"
         counter += 1
-    body = g.settings.response_body
-
-    # calculate age in words
-    age = age_to_words(time.time() - g.user.created_utc)
-
-    combined = g.user.post_karma + g.user.comment_karma
-    formatted_body = body.format(username=g.user.username,
-                                 post_karma=g.user.post_karma,
-                                 comment_karma=g.user.comment_karma,
-                                 combined_karma=combined,
-                                 age=age,
-                                 is_verified=g.user.verified_email,
-                                 is_mod=g.user.is_mod,
-                                 response=out)
-    g.user.full_body_md = formatted_body
-    g.user.full_body_html = markdown.markdown(formatted_body)
-    title_template = g.settings.response_title
-    formatted_title = title_template.format(username=g.user.username,
-                                            post_karma=g.user.post_karma,
-                                            comment_karma=g.user.comment_karma,
-                                            combined_karma=combined,
-                                            age=age,
-                                            is_verified=g.user.verified_email,
-                                            is_mod=g.user.is_mod)
-    g.user.response_title = formatted_title
+    templates = get_templates(g.settings)
+    context = render_context(g.user, response=out)
+    g.user.full_body_md = templates["response_body"].render(context)
+    g.user.response_title = templates["response_title"].render(context)
+    # a resubmission (after an exemption) goes back into the queue
+    counters.move(counters.state(g.user), "pending")
     g.user.submitted = True
+    g.user.processed = False
+    g.user.process_attempts = 0
+    g.user.process_error = None
+    g.user.process_after = None
+    g.user.process_failed = False
     g.user.is_exempt = False  # clear exemption after form is submitted
     db.session.add(g.user)
-    db.session.commit()
 
     if g.settings.message_user:
-        subject = g.settings.message_subject.format(
-            username=g.user.username,
-            post_karma=g.user.post_karma,
-            comment_karma=g.user.comment_karma,
-            combined_karma=combined,
-            age=age,
-            is_verified=g.user.verified_email,
-            is_mod=g.user.is_mod)
-        body = g.settings.message_body.format(
-            username=g.user.username,
-            post_karma=g.user.post_karma,
-            comment_karma=g.user.comment_karma,
-            combined_karma=combined,
-            age=age,
-            is_verified=g.user.verified_email,
-            is_mod=g.user.is_mod)
-        send_message(g.user.username, subject, body)
+        subject = templates["message_subject"].render(context)
+        body = templates["message_body"].render(context)
+        # delivered by the jobs worker so the user doesn't wait on reddit.
+        # it's committed with the submission, so neither exists without the
+        # other
+        enqueue_message(g.user.username, subject, body)
+    db.session.commit()
 
     return render_template("success.html", settings=g.settings)
 
 
 @app.route('/preview')
+@cached_page()
 def preview():
     # a view-only preview of the form
-    if not g.settings.preview_allowed and (not g.user and not g.user.form_mod):
+    if not g.settings.preview_allowed and not (g.user and g.user.form_mod):
         return abort(403)
-    copy = json.loads(g.settings.questions)
-    for q in copy:
-        q["id"] = ""
-        if "data" in q.keys():
-            # add ids to data
-            new_data = []
-            for d in q["data"]:
-                new_data.append(["", d])
-            q["data"] = new_data
-        q["response"] = None
-    return render_template("form.html", data=copy, preview=True)
+    data = get_schema(g.settings.question_set_id).preview
+    return render_template("form.html", data=data, preview=True)
 
 
 @app.route('/contact')
@@ -0,0 +1,104 @@
+# shows the query plans (and timings) of the hot User queries with and
+# without the indexes declared in models.py.
+#
+#   python benchmarks/user_indexes.py [rows] [database url]
+#
+# defaults to 100000 rows in a throwaway SQLite file. the database url, if
+# given, must point at an empty database since the User table is dropped.
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, func, select, text  # noqa: E402
+from models import User  # noqa: E402
+
+table = User.__table__
+
+QUERIES = {
+    "process (claim due submissions)": select([table.c.id]).where(
+        table.c.submitted == True).where(  # noqa: E712
+        table.c.processed == False).where(  # noqa: E712
+        table.c.process_failed == False).where(  # noqa: E712
+        (table.c.process_after == None) |  # noqa: E711
+        (table.c.process_after <= int(time.time()))).order_by(
+        table.c.process_attempts, table.c.id).limit(25),
+    "queue (count unprocessed)": select([func.count()]).select_from(
+        table).where(table.c.processed == False),  # noqa: E712
+    "lower(username) lookup": select([table.c.id]).where(
+        func.lower(table.c.username) == func.lower("User54321")),
+}
+
+
+def populate(engine, rows):
+    table.drop(engine, checkfirst=True)
+    # create the table without its indexes
+    indexes = list(table.indexes)
+    table.indexes.clear()
+    table.create(engine)
+    table.indexes.update(indexes)
+    batch = []
+    for i in range(rows):
+        submitted = random.random() < 0.9
+        processed = submitted and random.random() < 0.95
+        # a few pending rows are waiting to be retried, or were given up on
+        attempts = 0 if processed or random.random() < 0.9 else \
+            random.randint(1, 5)
+        batch.append({"username": f"user{i}",
+                      "submitted": submitted,
+                      "processed": processed,
+                      "process_attempts": attempts,
+                      "process_failed": attempts == 5,
+                      "process_after": int(time.time()) + 60 if 0 < attempts < 5
+                      else None,
+                      "response": "x" * 200})
+        if len(batch) == 5000:
+            engine.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        engine.execute(table.insert(), batch)
+
+
+def explain(engine, query):
+    compiled = query.compile(engine, compile_kwargs={"literal_binds": True})
+    if engine.dialect.name == "sqlite":
+        sql = f"EXPLAIN QUERY PLAN {compiled}"
+        return [row[-1] for row in engine.execute(text(sql))]
+    return [row[0] for row in engine.execute(text(f"EXPLAIN {compiled}"))]
+
+
+def timed(engine, query, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        engine.execute(query).fetchall()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def report(engine, label):
+    print(f"== {label}")
+    for name, query in QUERIES.items():
+        print(f"-- {name}: {timed(engine, query):.2f} ms")
+        for line in explain(engine, query):
+            print(f"   {line}")
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    if len(sys.argv) > 2:
+        url = sys.argv[2]
+    else:
+        url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(url)
+    populate(engine, rows)
+    report(engine, f"{rows} rows, no indexes")
+    for index in table.indexes:
+        index.create(engine)
+    engine.execute(text("ANALYZE"))
+    report(engine, f"{rows} rows, with indexes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from flask import current_app, g, make_response, request
+from functools import wraps
+from models import db, Settings
+import hashlib
+import os
+import threading
+
+# how long browsers and shared caches may reuse an anonymous page before
+# revalidating it. 0 means they always check back (and usually get a 304)
+PAGE_MAX_AGE = int(os.environ.get("PAGE_MAX_AGE", 0))
+
+
+class SettingsCache(object):
+    # keeps a detached copy of the Settings row in memory. each request only
+    # reads the row's version counter, and the full row is reloaded when a
+    # mod edit bumps it.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settings = None
+        self._version = None
+
+    def get(self):
+        # returns the current settings snapshot, reloading it if stale
+        row = db.session.query(Settings.version).order_by(Settings.id).first()
+        if row is None:
+            return None
+        version = row[0]
+        with self._lock:
+            if self._settings is not None and self._version == version:
+                return self._settings
+        s = Settings.query.order_by(Settings.id).first()
+        if s is None:
+            return None
+        db.session.expunge(s)
+        with self._lock:
+            self._settings = s
+            self._version = s.version
+        return s
+
+    @property
+    def version(self):
+        return self._version
+
+    def bump(self, settings):
+        # marks a live (session-attached) settings row as changed so every
+        # worker reloads it on its next request
+        settings.version = Settings.version + 1
+
+    def invalidate(self):
+        with self._lock:
+            self._settings = None
+            self._version = None
+        page_cache.clear()
+
+
+class PageCache(object):
+    # rendered response bodies keyed by (endpoint, settings version,
+    # variant). since the settings version is part of every key, an edit
+    # makes all older pages unreachable at once; they're dropped as soon
+    # as a newer version is seen.
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._version = None
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page):
+        with self._lock:
+            version = key[1]
+            if self._version is not None and version < self._version:
+                return  # rendered from settings that are already stale
+            if version != self._version:
+                self._pages.clear()
+                self._version = version
+            self._pages[key] = page
+            while len(self._pages) > self.maxsize:
+                self._pages.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._version = None
+
+
+settings_cache = SettingsCache()
+page_cache = PageCache()
+
+
+def user_variant():
+    # which version of a page the current visitor sees
+    if g.user is None:
+        return "anonymous"
+    return ("user", bool(g.user.is_mod), bool(g.user.form_mod))
+
+
+def cached_page(variant=user_variant):
+    # serves a view's rendered output from page_cache with a strong ETag,
+    # answering If-None-Match with a 304. `variant` returns whatever the
+    # page depends on besides the settings; non-200 responses aren't cached.
+    # goes below any access check decorators.
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            vary = variant()
+            key = (request.endpoint, g.settings.version, request.url_root,
+                   vary, tuple(sorted(kwargs.items())))
+            page = page_cache.get(key)
+            if page is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                page = (body, response.mimetype, etag)
+                page_cache.put(key, page)
+            body, mimetype, etag = page
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+            if g.user is None:
+                response.cache_control.public = True
+                response.cache_control.max_age = PAGE_MAX_AGE
+            else:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            response.vary.add("X-Api-Key")
+            return response.make_conditional(request)
+        return decorated_function
+    return decorator
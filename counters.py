@@ -0,0 +1,84 @@
+from models import db, Job, User, QueueCounter
+from jobs import enqueue, handler
+from sqlalchemy import func
+import os
+import time
+
+STATES = ["unsubmitted", "pending", "processed", "failed"]
+
+# seconds between scheduled reconciles
+RECONCILE_INTERVAL = int(os.environ.get("COUNTER_RECONCILE_INTERVAL", 3600))
+
+
+def state(user):
+    # which counter a User row belongs to
+    if not user.submitted:
+        return "unsubmitted"
+    if user.processed:
+        return "processed"
+    if user.process_failed:
+        return "failed"
+    return "pending"
+
+
+def add(name, n=1):
+    # adjusts a counter inside the caller's transaction
+    column = getattr(QueueCounter, name)
+    QueueCounter.query.filter_by(id=1).update(
+        {name: column + n}, synchronize_session=False)
+
+
+def move(old, new, n=1):
+    # moves n rows from one state to another inside the caller's transaction
+    if old == new or n == 0:
+        return
+    QueueCounter.query.filter_by(id=1).update(
+        {old: getattr(QueueCounter, old) - n,
+         new: getattr(QueueCounter, new) + n},
+        synchronize_session=False)
+
+
+def get():
+    return QueueCounter.query.get(1)
+
+
+def reconcile():
+    # recounts every state from the User table. the counter row is locked
+    # first so concurrent updates wait rather than get overwritten
+    counter = QueueCounter.query.filter_by(id=1).with_for_update().first()
+    if counter is None:
+        counter = QueueCounter(id=1)
+    totals = dict.fromkeys(STATES, 0)
+    rows = db.session.query(User.submitted, User.processed,
+                            User.process_failed, func.count()).group_by(
+        User.submitted, User.processed, User.process_failed)
+    for submitted, processed, failed, count in rows:
+        if not submitted:
+            totals["unsubmitted"] += count
+        elif processed:
+            totals["processed"] += count
+        elif failed:
+            totals["failed"] += count
+        else:
+            totals["pending"] += count
+    for name in STATES:
+        setattr(counter, name, totals[name])
+    counter.reconciled = int(time.time())
+    db.session.add(counter)
+    db.session.commit()
+    return counter
+
+
+def schedule_reconcile():
+    # makes sure a periodic reconcile job is queued
+    queued = Job.query.filter_by(kind="reconcile_counters").filter(
+        Job.status.in_(["pending", "running"])).first()
+    if not queued:
+        enqueue("reconcile_counters", {}, delay=RECONCILE_INTERVAL)
+        db.session.commit()
+
+
+@handler("reconcile_counters")
+def reconcile_job(payload, job):
+    reconcile()
+    enqueue("reconcile_counters", {}, delay=RECONCILE_INTERVAL)
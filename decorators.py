@@ -1,5 +1,6 @@
 from functools import wraps
 from flask import g, url_for, redirect, abort, request
+import profiling
 
 
 def login_required(f):
@@ -13,7 +14,7 @@ def login_required(f):
             elif '/api/' in request.path:
                 dest = "api." + dest
             return redirect(url_for('auth', next=dest))
-        return f(*args, **kwargs)
+        return profiling.call(f, *args, **kwargs)
     return decorated_function
 
 
@@ -30,7 +31,7 @@ def mod_required(f):
             return redirect(url_for('auth', next=dest))
         if not g.user.form_mod:
             return abort(403)
-        return f(*args, **kwargs)
+        return profiling.call(f, *args, **kwargs)
     return decorated_function
 
 
@@ -42,3 +43,15 @@ def api_disallowed(f):
             return abort(403)
         return f(*args, **kwargs)
     return decorated_function
+
+
+def read_only(f):
+    # lets the view's queries go to the read replica, when there is one.
+    # only for views that never write and can show slightly stale data;
+    # goes below any access check decorators so the user is loaded from
+    # the primary
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.read_only = True
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,102 @@
+from string import Formatter
+from utils import age_to_words
+import threading
+import time
+
+# placeholders every output template may use
+FIELDS = ["username", "post_karma", "comment_karma", "combined_karma", "age",
+          "is_verified", "is_mod"]
+
+# Settings columns that hold output templates, and any extra placeholders
+# each one allows
+TEMPLATES = {
+    "response_title": [],
+    "response_body": ["response"],
+    "message_subject": [],
+    "message_body": [],
+}
+
+# stand-in values used to check a template's format specs when it's saved
+SAMPLE = {"username": "spez", "post_karma": 1, "comment_karma": 1,
+          "combined_karma": 2, "age": "1 year", "is_verified": True,
+          "is_mod": False, "response": ""}
+
+_formatter = Formatter()
+
+
+class TemplateError(ValueError):
+    # raised for a template that can't be rendered
+    pass
+
+
+class CompiledTemplate(object):
+    # a str.format template, parsed once and checked against the
+    # placeholders it's allowed to use
+
+    def __init__(self, text, allowed):
+        self.text = text or ""
+        try:
+            self.parts = list(_formatter.parse(self.text))
+        except ValueError as e:
+            raise TemplateError(f"invalid template: {e}")
+        for literal, field, spec, conversion in self.parts:
+            if field is None:
+                continue
+            if field not in allowed:
+                raise TemplateError(
+                    f"unknown placeholder {{{field}}}; "
+                    f"allowed placeholders are {', '.join(allowed)}")
+            if "{" in spec:
+                raise TemplateError(
+                    f"nested placeholders aren't supported in {{{field}}}")
+        try:
+            self.render(SAMPLE)
+        except (ValueError, TypeError) as e:
+            raise TemplateError(f"invalid template: {e}")
+
+    def render(self, context):
+        out = []
+        for literal, field, spec, conversion in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = context[field]
+                if conversion:
+                    value = _formatter.convert_field(value, conversion)
+                out.append(format(value, spec))
+        return "".join(out)
+
+
+def compile_template(name, text):
+    # compiles the template stored in Settings.<name>
+    return CompiledTemplate(text, FIELDS + TEMPLATES[name])
+
+
+def render_context(user, response=""):
+    # the values templates are rendered with. built once per submission
+    return {"username": user.username,
+            "post_karma": user.post_karma,
+            "comment_karma": user.comment_karma,
+            "combined_karma": user.post_karma + user.comment_karma,
+            "age": age_to_words(time.time() - user.created_utc),
+            "is_verified": user.verified_email,
+            "is_mod": user.is_mod,
+            "response": response}
+
+
+_lock = threading.Lock()
+_compiled = (None, None)
+
+
+def get_templates(settings):
+    # returns {name: CompiledTemplate} for the current settings version
+    global _compiled
+    with _lock:
+        version, templates = _compiled
+    if templates is not None and version == settings.version:
+        return templates
+    templates = {}
+    for name in TEMPLATES:
+        templates[name] = compile_template(name, getattr(settings, name))
+    with _lock:
+        _compiled = (settings.version, templates)
+    return templates
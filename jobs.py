@@ -0,0 +1,152 @@
+from models import db, Job
+from reddit import client
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# kind -> function(payload, job) that raises on failure
+HANDLERS = {}
+
+# seconds a claimed job is held before another worker may retry it
+LEASE = 300
+POLL_INTERVAL = float(os.environ.get("JOBS_POLL_INTERVAL", 2))
+BATCH_SIZE = 10
+
+
+def handler(kind):
+    # registers a job handler
+    def decorator(f):
+        HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def enqueue(kind, payload, delay=0):
+    # adds a job to the session. it's committed along with whatever else the
+    # caller is saving, so the job exists exactly when that data does.
+    now = int(time.time())
+    job = Job(kind=kind, payload=json.dumps(payload), status="pending",
+              run_at=now + delay, created=now, updated=now)
+    db.session.add(job)
+    return job
+
+
+def enqueue_message(user, subject, body):
+    return enqueue("message", {"to": user, "subject": subject, "body": body})
+
+
+def backoff(attempts):
+    # 30s, 1m, 2m, 4m... capped at an hour, with some jitter
+    delay = min(30 * 2 ** (attempts - 1), 3600)
+    return int(delay + random.uniform(0, delay / 4))
+
+
+def claim(limit=BATCH_SIZE):
+    # marks up to `limit` due jobs as running for this worker. the status
+    # check in the UPDATE means two workers can never claim the same job.
+    now = int(time.time())
+    candidates = db.session.query(Job.id, Job.status).filter(
+        Job.run_at <= now,
+        db.or_(Job.status == "pending",
+               db.and_(Job.status == "running", Job.locked_until < now))
+    ).order_by(Job.run_at).limit(limit).all()
+    claimed = []
+    for job_id, status in candidates:
+        result = db.session.query(Job).filter(
+            Job.id == job_id, Job.status == status,
+            db.or_(Job.locked_until.is_(None), Job.locked_until < now)
+        ).update({"status": "running", "locked_until": now + LEASE,
+                  "updated": now}, synchronize_session=False)
+        if result == 1:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+
+def run(job):
+    # runs one claimed job and records the outcome
+    attempts = (job.attempts or 0) + 1
+    now = int(time.time())
+    job.attempts = attempts
+    job.updated = now
+    try:
+        f = HANDLERS[job.kind]
+        f(json.loads(job.payload), job)
+    except Exception as e:
+        # whatever the handler left uncommitted goes, not just the job
+        db.session.rollback()
+        job.attempts = attempts
+        job.updated = now
+        job.last_error = f"{type(e).__name__}: {e}"
+        if job.attempts >= job.max_attempts:
+            job.status = "failed"
+            log.warning("job %s (%s) failed for good: %s",
+                        job.id, job.kind, job.last_error)
+        else:
+            job.status = "pending"
+            job.run_at = job.updated + backoff(job.attempts)
+    else:
+        job.status = "done"
+        job.last_error = None
+    job.locked_until = None
+    db.session.add(job)
+    db.session.commit()
+
+
+def work_once():
+    # claims and runs a batch of jobs, returning how many were run
+    claimed = claim()
+    for job_id in claimed:
+        run(Job.query.get(job_id))
+    return len(claimed)
+
+
+def work(app, stop=None):
+    # runs jobs until `stop` is set, sleeping when there's nothing to do
+    while stop is None or not stop.is_set():
+        with app.app_context():
+            try:
+                count = work_once()
+            except Exception:
+                log.exception("jobs worker iteration failed")
+                db.session.rollback()
+                count = 0
+            finally:
+                db.session.remove()
+        if count == 0:
+            time.sleep(POLL_INTERVAL)
+
+
+_worker = None
+
+
+def start_worker(app):
+    # starts a background thread for this process, unless JOBS_WORKER=off
+    # (e.g. when a separate `python jobs.py` worker process is used)
+    global _worker
+    if os.environ.get("JOBS_WORKER", "thread").lower() == "off":
+        return
+    if _worker is not None and _worker.is_alive():
+        return
+    _worker = threading.Thread(target=work, args=(app,), name="jobs-worker",
+                               daemon=True)
+    _worker.start()
+
+
+@handler("message")
+def deliver_message(payload, job):
+    client.send_message(payload["to"], payload["subject"], payload["body"])
+
+
+if __name__ == '__main__':
+    # import through the package name so handlers registered by other
+    # modules end up in the same HANDLERS table
+    import jobs
+    from app import app
+    logging.basicConfig(level=logging.INFO)
+    jobs.work(app)
@@ -0,0 +1,201 @@
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds for the number of queries a request makes
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# every metric, in the order /api/metrics lists them
+REGISTRY = []
+# functions called after every database statement with (conn, statement,
+# parameters, context, executemany, elapsed seconds). see on_query
+QUERY_HOOKS = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", r"\\").replace(
+            "\n", r"\n").replace('"', r'\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter(object):
+    # a count per label set. kept in memory, per process
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, n=1):
+        # labels are kept as text, so a slot can mix e.g. 200 and "error"
+        labels = tuple(map(str, labels))
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(object):
+    # counts of observations by bucket, plus their sum, per label set
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> [count in each bucket..., count above the last, sum]
+        self._values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, *labels):
+        labels = tuple(map(str, labels))
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        names = self.labels + ("le",)
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield (f"{self.name}_bucket"
+                       f"{_labels(names, labels + (bound,))} {total}")
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {total}"
+
+
+request_seconds = Histogram(
+    "rforms_request_seconds", "Time spent handling a request.",
+    ("endpoint", "method", "status"))
+request_queries = Histogram(
+    "rforms_request_queries", "Database queries made by a request.",
+    ("endpoint",), QUERY_BUCKETS)
+query_seconds = Histogram(
+    "rforms_db_query_seconds",
+    "Time spent in database queries, by the endpoint that made them.",
+    ("endpoint",))
+call_seconds = Histogram(
+    "rforms_call_seconds",
+    "Time spent in instrumented functions (reddit calls, rendering).",
+    ("function", "outcome"))
+reddit_responses = Counter(
+    "rforms_reddit_responses_total",
+    "Responses from reddit by reddit.py function and status.",
+    ("function", "status"))
+
+
+def endpoint():
+    # what to attribute the current work to: the request's endpoint, or
+    # "background" outside a request
+    if has_request_context():
+        return request.endpoint or "unmatched"
+    return "background"
+
+
+def timed(name):
+    # records how long each call to the function takes, and whether it
+    # raised, in rforms_call_seconds
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = f(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                call_seconds.observe(time.perf_counter() - start, name,
+                                     outcome)
+        return decorated_function
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, "_metrics_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    query_seconds.observe(elapsed, endpoint())
+    if has_request_context():
+        g.metrics_queries = g.get("metrics_queries", 0) + 1
+    for hook in QUERY_HOOKS:
+        hook(conn, statement, parameters, context, executemany, elapsed)
+
+
+def on_query(hook):
+    # registers a function to run after each statement, reusing the timing
+    # taken here rather than adding another pair of engine listeners
+    if hook not in QUERY_HOOKS:
+        QUERY_HOOKS.append(hook)
+    return hook
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def _record_request(response):
+    start = g.get("metrics_start")
+    if start is not None:
+        name = endpoint()
+        request_seconds.observe(time.perf_counter() - start, name,
+                                request.method, response.status_code)
+        request_queries.observe(g.get("metrics_queries", 0), name)
+    return response
+
+
+def init_app(app):
+    # starts timing requests and queries. call before any other
+    # before_request hooks are registered so their queries are counted
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    if not event.contains(Engine, "before_cursor_execute",
+                          _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def render():
+    # every metric in the prometheus text format
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
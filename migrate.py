@@ -0,0 +1,51 @@
+from sqlalchemy import inspect
+from models import db
+
+# columns added after the first release. create_all() only creates missing
+# tables, so existing deployments get these through upgrade()
+COLUMNS = [
+    ("Settings", "version", "INTEGER DEFAULT 1"),
+    ("Settings", "question_set_id", "INTEGER"),
+    ("User", "question_set_id", "INTEGER"),
+    ("User", "api_key_hash", "VARCHAR"),
+    ("User", "api_key_prefix", "VARCHAR"),
+    ("User", "process_attempts", "INTEGER DEFAULT 0"),
+    ("User", "process_error", "VARCHAR"),
+    ("User", "process_after", "INTEGER"),
+    ("User", "process_failed", "BOOLEAN DEFAULT FALSE"),
+    ("QueueCounter", "failed", "INTEGER DEFAULT 0"),
+]
+
+
+def index_names(engine):
+    # names of existing indexes. read from the catalog directly, since the
+    # inspector skips expression indexes on some backends
+    if engine.dialect.name == "sqlite":
+        rows = engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+    elif engine.dialect.name == "postgresql":
+        rows = engine.execute("SELECT indexname FROM pg_indexes")
+    else:
+        inspector = inspect(engine)
+        return {i["name"] for t in inspector.get_table_names()
+                for i in inspector.get_indexes(t)}
+    return {row[0] for row in rows}
+
+
+def upgrade():
+    # brings an existing database up to date with models.py
+    inspector = inspect(db.engine)
+    tables = inspector.get_table_names()
+    for table, column, ddl in COLUMNS:
+        if table not in tables:
+            continue
+        existing = [c["name"] for c in inspector.get_columns(table)]
+        if column not in existing:
+            db.engine.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} {ddl}')
+
+    # create_all() doesn't add indexes to tables that already exist
+    existing = index_names(db.engine)
+    for table in db.Model.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
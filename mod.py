@@ -1,11 +1,20 @@
-from flask import Blueprint, abort, jsonify, render_template, request
-from decorators import mod_required, api_disallowed
+from cache import cached_page, user_variant
+from flask import Blueprint, abort, g, jsonify, render_template, request
+from decorators import mod_required, api_disallowed, read_only
 from models import User
+from rendering import render_html
 from sqlalchemy import func
+from sqlalchemy.orm import load_only
+from urllib.parse import urlencode
 import json
 
 mod = Blueprint('mod', __name__, template_folder='templates')
 
+MAX_PAGE_SIZE = 1000
+# columns the user list needs; the big response columns stay unloaded
+LIST_COLUMNS = [User.id, User.username, User.submitted, User.form_mod,
+                User.is_exempt, User.eligible_for_exemption]
+
 
 @mod.route('/settings')
 @mod_required
@@ -17,48 +26,53 @@ def settings():
 @mod.route('/users')
 @mod_required
 @api_disallowed
+@read_only
 def users():
-    # manage users
-    page = int(request.args.get('page', 1))
-    count = int(request.args.get('limit', 25))
-    None if page == 1 else page - 1
-    if page == 1:
-        button_back = False
-    else:
-        button_back = f"/mod/users?page={page-1}&limit={count}"
-    button_next = f"/mod/users?page={page+1}&limit={count}"
+    # manage users. pages are keyed on id (?after=<id> or ?before=<id>) so
+    # deep pages cost the same as the first one
+    count = min(int(request.args.get('limit', 25)), MAX_PAGE_SIZE)
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    # only load the columns users.html shows
+    query = User.query.options(load_only(*LIST_COLUMNS))
     if request.args.get('user') is not None:
         username = request.args.get('user')
-        users = User.query.filter(
+        user = query.filter(
             func.lower(
                 User.username) == func.lower(username)).first()
-        return render_template("users.html", users=[users])
-    elif request.args.get('mod') is not None:
+        return render_template("users.html", users=[user] if user else [])
+
+    params = {"limit": count}
+    if request.args.get('mod') is not None:
         raw = str(request.args.get('mod')).lower()
-        if raw == "false":
-            mod = False
-        else:
-            mod = True
-        users = User.query.filter_by(
-            form_mod=mod).paginate(
-            page, count, False).items
-        if button_back:
-            button_back += f"&mod={raw}"
-        button_next += f"&mod={raw}"
+        query = query.filter_by(form_mod=(raw != "false"))
+        params["mod"] = raw
     elif request.args.get('exempt') is not None:
         raw = str(request.args.get('exempt')).lower()
-        if raw == "false":
-            exempt = False
-        else:
-            exempt = True
-        users = User.query.filter_by(
-            is_exempt=exempt).paginate(
-            page, count, False).items
-        if button_back:
-            button_back += f"&exempt={raw}"
-        button_next += f"&exempt={raw}"
+        query = query.filter_by(is_exempt=(raw != "false"))
+        params["exempt"] = raw
+
+    # fetch one extra row to see whether there's another page
+    if before is not None:
+        rows = query.filter(User.id < before).order_by(
+            User.id.desc()).limit(count + 1).all()
+        has_prev = len(rows) > count
+        users = list(reversed(rows[:count]))
+        has_next = True
     else:
-        users = User.query.paginate(page, count, False).items
+        if after is not None:
+            query = query.filter(User.id > after)
+        rows = query.order_by(User.id).limit(count + 1).all()
+        has_next = len(rows) > count
+        users = rows[:count]
+        has_prev = after is not None
+
+    button_back = False
+    button_next = False
+    if users and has_prev:
+        button_back = "/mod/users?" + urlencode(dict(params, before=users[0].id))
+    if users and has_next:
+        button_next = "/mod/users?" + urlencode(dict(params, after=users[-1].id))
     button_data = [button_back, button_next]
     return render_template("users.html", users=users, button_data=button_data)
 
@@ -66,6 +80,7 @@ def users():
 @mod.route('/user/<string:username>')
 @mod_required
 @api_disallowed
+@read_only
 def user_lookup(username):
     # shows a user's page
     is_json = False
@@ -78,20 +93,24 @@ def user_lookup(username):
         # check to see if a similar username exists
         user = User.query.filter(User.username.ilike(username)).first()
         show_warning = True
-    if user.username.lower() == username.lower():
-        show_warning = False
     if not user:
         return abort(404)
+    if user.username.lower() == username.lower():
+        show_warning = False
     if is_json:
         return jsonify(username=user.username,
                        response_md=user.full_body_md,
-                       response_html=user.full_body_html,
+                       response_html=render_html(user.full_body_md),
                        submitted=user.submitted,
                        processed=user.processed,
+                       process_failed=user.process_failed,
+                       process_attempts=user.process_attempts,
+                       process_error=user.process_error,
                        last_login=user.last_login)
     return render_template(
         "user.html",
         user=user,
+        html=render_html(user.full_body_md),
         username=username,
         show_warning=show_warning)
 
@@ -110,6 +129,7 @@ def response():
 
 @mod.route('/api')
 @mod_required
+@cached_page(lambda: (user_variant(), g.user.id, g.user.api_key_prefix))
 def api():
     with open("data/api_docs.json") as api_docs:
         data = json.loads(api_docs.read())
@@ -1,7 +1,30 @@
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 import time
 
-db = SQLAlchemy()
+# SQLALCHEMY_BINDS key of the optional read replica
+REPLICA = "replica"
+
+
+class RoutingSession(SignallingSession):
+    # sends queries to the read replica while a view marked with
+    # decorators.read_only is running, if a replica is configured.
+    # everything else, including any flush, goes to the primary
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing and has_app_context()
+                and g.get("read_only", False)
+                and REPLICA in (self.app.config.get("SQLALCHEMY_BINDS") or {})):
+            return db.get_engine(self.app, bind=REPLICA)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 
 class User(db.Model):
@@ -14,23 +37,61 @@ class User(db.Model):
     is_mod = db.Column(db.Boolean)
     form_mod = db.Column(db.Boolean, default=False)
     verified_email = db.Column(db.Boolean)
+    # the QuestionSet this user's answers belong to
+    question_set_id = db.Column(db.Integer)
+    # json list of answers, indexed by question
     response = db.Column(db.String)
     full_body_md = db.Column(db.String)
+    # no longer written; html is rendered on demand by rendering.py
     full_body_html = db.Column(db.String)
     response_title = db.Column(db.String)
     submitted = db.Column(db.Boolean, default=False)
     processed = db.Column(db.Boolean, default=False)
+    # delivery attempts by /api/process. a submission that keeps failing is
+    # retried with backoff and then set aside as failed
+    process_attempts = db.Column(db.Integer, default=0)
+    process_error = db.Column(db.String)
+    process_after = db.Column(db.Integer)  # earliest time of the next attempt
+    process_failed = db.Column(db.Boolean, default=False)
     form_reply_link = db.Column(db.String)
+    # plaintext keys from before they were hashed; cleared at startup
     api_key = db.Column(db.String, unique=True)
+    # keyed hash of the user's api key, and the key's first few characters
+    # so it can be found without scanning (see apikeys.py)
+    api_key_hash = db.Column(db.String)
+    api_key_prefix = db.Column(db.String, index=True)
     is_exempt = db.Column(db.Boolean, default=False)
     eligible_for_exemption = db.Column(db.Boolean)
-    last_login = db.Column(db.Integer, default=int(time.time()))
+    last_login = db.Column(db.Integer, default=lambda: int(time.time()))
     last_api_access = db.Column(db.Integer)
 
+    __table_args__ = (
+        # the submission queue: /api/queue, reconcile and the exports
+        db.Index('ix_User_queue', 'processed', 'submitted', 'id'),
+        # /api/process's claim, read in the order it delivers
+        db.Index('ix_User_process', 'submitted', 'processed', 'process_failed',
+                 'process_attempts', 'id'),
+    )
+
+
+# case-insensitive username lookups in the mod tools
+db.Index('ix_User_username_lower', db.func.lower(User.username))
+
+
+class QuestionSet(db.Model):
+    # an immutable version of the form's questions. editing the questions
+    # adds a new row, so answers stay tied to what the user was shown
+    __tablename__ = 'QuestionSet'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    questions = db.Column(db.String)
+    created = db.Column(db.Integer, default=lambda: int(time.time()))
+
 
 class Settings(db.Model):
     __tablename__ = 'Settings'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # bumped on every edit so cached copies know to reload
+    version = db.Column(db.Integer, default=1)
     accepting = db.Column(db.Boolean, default=False)  # form enabled/disabled
     # homepage
     site_title = db.Column(db.String, default="subreddit form site")
@@ -39,10 +100,9 @@ class Settings(db.Model):
         default="welcome to the form site!")  # homepage information
     # form page
     instructions = db.Column(db.String, default="Please fill this form out.")
-    # questions
+    # questions. the editable copy; submissions reference question_set_id
     questions = db.Column(db.String, default="[]")
-    # number of random IDs to generate
-    required_ids = db.Column(db.Integer, default=0)
+    question_set_id = db.Column(db.Integer)
     # form config
     # karma a user needs to view the form
     min_karma = db.Column(db.Integer, default=-100)
@@ -65,3 +125,47 @@ class Settings(db.Model):
     contact_destination = db.Column(db.String, default="me")
     google_analytics_enabled = db.Column(db.Boolean, default=False)
     google_analytics_id = db.Column(db.String, default="")
+
+
+class Job(db.Model):
+    # outbound work (e.g. reddit messages) delivered by the jobs worker
+    __tablename__ = 'Job'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind = db.Column(db.String)
+    payload = db.Column(db.String)  # json
+    # pending, running, done or failed
+    status = db.Column(db.String, default="pending")
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, default=8)
+    # earliest time the job may run, for retry backoff
+    run_at = db.Column(db.Integer, default=lambda: int(time.time()))
+    # a running job whose lease has passed is picked up again
+    locked_until = db.Column(db.Integer)
+    last_error = db.Column(db.String)
+    created = db.Column(db.Integer, default=lambda: int(time.time()))
+    updated = db.Column(db.Integer, default=lambda: int(time.time()))
+
+
+class Archive(db.Model):
+    # a User row removed by /api/clear, compressed. written in the same
+    # transaction as the delete, so purged submissions can still be audited
+    __tablename__ = 'Archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, index=True)  # the row's User.id
+    username = db.Column(db.String, index=True)
+    codec = db.Column(db.String)  # "zstd" or "gzip"
+    data = db.Column(db.LargeBinary)  # the row's columns as compressed json
+    job_id = db.Column(db.Integer)  # the purge that removed it
+    archived = db.Column(db.Integer, default=lambda: int(time.time()))
+
+
+class QueueCounter(db.Model):
+    # running totals of User rows by submission state, so queue depth is a
+    # single-row read. counters.reconcile() corrects any drift.
+    __tablename__ = 'QueueCounter'
+    id = db.Column(db.Integer, primary_key=True)
+    unsubmitted = db.Column(db.Integer, default=0)
+    pending = db.Column(db.Integer, default=0)  # submitted, not processed
+    processed = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)  # gave up delivering
+    reconciled = db.Column(db.Integer)  # time of the last reconcile
@@ -0,0 +1,140 @@
+from collections import Counter
+from flask import g, make_response, request
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# profile 1 in this many logged-in requests to PROFILE_DIR (0 turns it off)
+SAMPLE_RATE = int(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/rforms-profiles")
+# how many sampled profiles are kept; the oldest are removed first
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+# seconds between stack samples in "collapsed" mode
+SAMPLE_INTERVAL = 0.005
+# lines of the report returned in "pstats" mode
+REPORT_LINES = 60
+
+MODES = ["pstats", "collapsed"]
+
+
+class StackSampler(object):
+    # samples one thread's stack on a timer and counts each distinct stack,
+    # for flamegraph.pl / speedscope ("collapsed" format). much cheaper than
+    # cProfile on deep call trees, at the cost of being statistical
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="profile-sampler")
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} "
+                             f"({os.path.basename(code.co_filename)}"
+                             f":{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.stacks.most_common())
+
+
+def requested_mode():
+    # the profile a mod asked for with X-Profile or ?profile=, if any
+    mode = request.headers.get("X-Profile") or request.args.get("profile")
+    if mode not in MODES or not (g.user and g.user.form_mod):
+        return None
+    return mode
+
+
+def _report(profile):
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(REPORT_LINES)
+    return out.getvalue()
+
+
+def _profiled_response(mode, f, args, kwargs):
+    # runs the view under the requested profiler and returns the profile in
+    # place of the page
+    start = time.perf_counter()
+    if mode == "collapsed":
+        with StackSampler() as sampler:
+            response = make_response(f(*args, **kwargs))
+        body = sampler.collapsed()
+    else:
+        profile = cProfile.Profile()
+        response = make_response(profile.runcall(f, *args, **kwargs))
+        body = _report(profile)
+    out = make_response(body)
+    out.mimetype = "text/plain"
+    out.headers["X-Profiled-Status"] = str(response.status_code)
+    out.headers["X-Profiled-Seconds"] = f"{time.perf_counter() - start:.4f}"
+    out.headers["Cache-Control"] = "no-store"
+    return out
+
+
+def _save(profile):
+    # writes a profile to the ring in PROFILE_DIR and trims the oldest
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    endpoint = (request.endpoint or "unmatched").replace(".", "-")
+    name = f"{int(time.time() * 1000)}-{os.getpid()}-{endpoint}.prof"
+    profile.dump_stats(os.path.join(PROFILE_DIR, name))
+    saved = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".prof"))
+    for old in saved[:max(len(saved) - PROFILE_KEEP, 0)]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass  # removed by another process
+
+
+def saved_profiles():
+    # names of the profiles in the ring, newest first
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return []
+    return sorted((n for n in names if n.endswith(".prof")), reverse=True)
+
+
+def call(f, *args, **kwargs):
+    # calls a view, profiling it if a mod asked for that or it was picked
+    # for sampling. used by the decorators that load the user
+    mode = requested_mode()
+    if mode is not None:
+        return _profiled_response(mode, f, args, kwargs)
+    if SAMPLE_RATE and random.randrange(SAMPLE_RATE) == 0:
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(f, *args, **kwargs)
+        finally:
+            try:
+                _save(profile)
+            except OSError:
+                log.warning("couldn't save a sampled profile", exc_info=True)
+    return f(*args, **kwargs)
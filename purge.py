@@ -0,0 +1,124 @@
+from models import db, Archive, Job, User
+from jobs import LEASE, enqueue, handler
+from sqlalchemy import inspect
+import apikeys
+import counters
+import gzip
+import json
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# rows archived and deleted per transaction
+CHUNK = int(os.environ.get("PURGE_CHUNK", 500))
+
+# which User rows each purge scope removes
+SCOPES = {
+    "all": [],
+    "processed": [User.submitted == True, User.processed == True],  # noqa: E712
+}
+
+# (attribute, column name) for every User column, read from the model once
+USER_FIELDS = [(attr.key, attr.columns[0].name)
+               for attr in inspect(User).column_attrs]
+
+
+def compress(data):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor().compress(data)
+    return "gzip", gzip.compress(data)
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def archive(user, job_id):
+    # an Archive row holding everything in a User row
+    row = {name: getattr(user, attr) for attr, name in USER_FIELDS}
+    codec, data = compress(json.dumps(row).encode())
+    return Archive(user_id=user.id, username=user.username, codec=codec,
+                   data=data, job_id=job_id)
+
+
+def start(scope):
+    # queues a purge of the given scope, or returns the purge that's already
+    # queued or running (whatever its scope) so two can't run side by side.
+    # the caller commits
+    job = Job.query.filter(Job.kind == "purge",
+                           Job.status.in_(["pending", "running"])
+                           ).order_by(Job.id).first()
+    if job is not None:
+        return job
+    return enqueue("purge", {"scope": scope, "last_id": 0, "archived": 0,
+                             "started": int(time.time()), "finished": None})
+
+
+def progress(job):
+    # what a purge job has done so far, for the status endpoint
+    payload = json.loads(job.payload)
+    remaining = User.query.filter(
+        User.id > payload["last_id"], *SCOPES[payload["scope"]]).count()
+    return {"id": job.id,
+            "status": job.status,
+            "scope": payload["scope"],
+            "archived": payload["archived"],
+            "remaining": remaining,
+            "started": payload["started"],
+            "finished": payload["finished"],
+            "last_error": job.last_error}
+
+
+def purge_chunk(payload, job):
+    # archives and deletes the next chunk of rows, saving progress in the
+    # same transaction. returns how many rows were looked at. rows are
+    # locked as they're read and rows locked elsewhere (e.g. being processed
+    # or purged) are skipped, and the counters only move by what was
+    # actually deleted
+    users = User.query.filter(
+        User.id > payload["last_id"], *SCOPES[payload["scope"]]
+    ).order_by(User.id).limit(CHUNK).with_for_update(skip_locked=True).all()
+    if not users:
+        return 0
+    by_state = {}
+    for user in users:
+        by_state.setdefault(counters.state(user), []).append(user)
+    archived = 0
+    for name, group in by_state.items():
+        for user in group:
+            db.session.add(archive(user, job.id))
+        n = User.query.filter(User.id.in_([user.id for user in group])).delete(
+            synchronize_session=False)
+        if n != len(group):
+            # deleted by someone else since it was read; start the chunk over
+            raise RuntimeError(f"expected to delete {len(group)} {name} rows, "
+                               f"deleted {n}")
+        counters.add(name, -n)
+        archived += n
+    ids = [user.id for user in users]
+    payload["last_id"] = ids[-1]
+    payload["archived"] += archived
+    # keep the lease while there's work left, so no other worker picks it up
+    job.locked_until = int(time.time()) + LEASE
+    job.payload = json.dumps(payload)
+    db.session.add(job)
+    db.session.commit()
+    for user_id in ids:
+        apikeys.key_cache.evict(user_id)
+    return len(ids)
+
+
+@handler("purge")
+def purge_job(payload, job):
+    # runs a purge to the end. an interrupted purge resumes from the last
+    # committed chunk when its job is retried
+    while purge_chunk(payload, job):
+        pass
+    payload["finished"] = int(time.time())
+    job.payload = json.dumps(payload)
@@ -0,0 +1,117 @@
+from collections import Counter, deque
+from flask import g, has_request_context, request
+from metrics import endpoint, on_query
+import logging
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# statements slower than this (in milliseconds) are logged and explained
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 250))
+# requests making more queries than this are flagged (0 turns it off)
+QUERY_LIMIT = int(os.environ.get("QUERY_LIMIT", 0))
+LOG_SIZE = 100
+# longest parameter list kept, as text
+PARAMS_CHARS = 500
+
+slow_queries = deque(maxlen=LOG_SIZE)
+busy_requests = deque(maxlen=LOG_SIZE)
+
+# slow statements waiting for an EXPLAIN. when it's full, new ones go
+# unexplained rather than slowing anything down
+_pending = queue.Queue(maxsize=LOG_SIZE)
+_explainer = None
+_lock = threading.Lock()
+
+
+def explain(engine, statement, parameters):
+    # the query plan for a statement, from its own connection so it can't
+    # disturb the transaction that ran it
+    if engine.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(prefix + statement, parameters)
+        rows = cursor.fetchall()
+        cursor.close()
+    finally:
+        connection.close()
+    return ["  ".join(str(value) for value in row) for row in rows]
+
+
+def _explain_pending():
+    while True:
+        entry, engine, parameters = _pending.get()
+        try:
+            entry["plan"] = explain(engine, entry["statement"], parameters)
+        except Exception as e:
+            entry["plan"] = [f"EXPLAIN failed: {type(e).__name__}: {e}"]
+
+
+def _queue_explain(entry, engine, parameters):
+    global _explainer
+    with _lock:
+        if _explainer is None:
+            _explainer = threading.Thread(target=_explain_pending,
+                                          name="query-explainer", daemon=True)
+            _explainer.start()
+    try:
+        _pending.put_nowait((entry, engine, parameters))
+    except queue.Full:
+        entry["plan"] = None
+
+
+def _record_query(conn, statement, parameters, context, executemany,
+                  elapsed):
+    # called by metrics after each statement, with its run time in seconds
+    if QUERY_LIMIT and has_request_context():
+        statements = g.get("querylog_statements")
+        if statements is None:
+            statements = g.querylog_statements = Counter()
+        statements[statement] += 1
+    ms = elapsed * 1000
+    if ms < SLOW_QUERY_MS:
+        return
+    entry = {"time": int(time.time()),
+             "ms": round(ms, 1),
+             "endpoint": endpoint(),
+             "statement": statement,
+             "parameters": repr(parameters)[:PARAMS_CHARS],
+             "plan": "pending"}
+    slow_queries.append(entry)
+    # only reads are explained; EXPLAIN can't run a write, but there's no
+    # need to find out the hard way
+    if not executemany and statement.lstrip()[:6].upper() == "SELECT":
+        _queue_explain(entry, conn.engine, parameters)
+    else:
+        entry["plan"] = None
+
+
+def _check_request(response):
+    statements = g.get("querylog_statements")
+    if not QUERY_LIMIT or statements is None:
+        return response
+    count = sum(statements.values())
+    if count > QUERY_LIMIT:
+        busy_requests.append({
+            "time": int(time.time()),
+            "endpoint": endpoint(),
+            "path": request.full_path,
+            "queries": count,
+            # the statements run most often are usually the N+1
+            "repeated": [{"statement": s, "count": n}
+                         for s, n in statements.most_common(5) if n > 1]})
+    return response
+
+
+def init_app(app):
+    # starts watching every engine's queries. statements are timed by
+    # metrics, so metrics.init_app must be called too
+    app.after_request(_check_request)
+    on_query(_record_query)
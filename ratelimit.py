@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    # paces calls to reddit. starts at a configured rate and then follows the
+    # X-Ratelimit-* headers reddit sends back, spreading whatever is left of
+    # the current window evenly over the time until it resets. callers that
+    # are over budget wait their turn instead of failing.
+
+    def __init__(self, rate, capacity):
+        self.default_rate = rate  # tokens per second
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.remaining = None  # as last reported by reddit
+        self.reset_at = None
+        self.waiting = 0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            # reddit's window has rolled over
+            self.rate = self.default_rate
+            self.remaining = None
+            self.reset_at = None
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        # blocks until a call may be made
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    if self.rate > 0:
+                        wait = (1 - self.tokens) / self.rate
+                    else:
+                        wait = self.reset_at - now
+                    self._cond.wait(max(wait, 0.01))
+            finally:
+                self.waiting -= 1
+
+    def update(self, remaining, reset):
+        # applies reddit's view of the budget: `remaining` calls allowed in
+        # the next `reset` seconds
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            self.remaining = remaining
+            self.reset_at = now + reset
+            self.tokens = min(self.tokens, remaining)
+            if reset > 0:
+                self.rate = max(remaining - self.tokens, 0) / reset
+            self._cond.notify_all()
+
+    def observe(self, response):
+        # reads the rate limit headers off a reddit response
+        headers = response.headers
+        try:
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            if response.status_code != 429:
+                return
+            # throttled without headers; back off for the retry window
+            try:
+                reset = float(headers.get("Retry-After", 60))
+            except ValueError:
+                reset = 60
+            remaining = 0
+        if response.status_code == 429:
+            remaining = 0
+        self.update(remaining, reset)
+
+    def budget(self):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            reset_in = None
+            if self.reset_at is not None:
+                reset_in = round(self.reset_at - now, 1)
+            return {"tokens": round(self.tokens, 2),
+                    "capacity": self.capacity,
+                    "rate_per_minute": round(self.rate * 60, 2),
+                    "remaining": self.remaining,
+                    "reset_in": reset_in,
+                    "waiting": self.waiting}
@@ -1,49 +1,262 @@
 from urllib.parse import urlencode
 import os
 import re
+from metrics import reddit_responses, timed
+from ratelimit import TokenBucket
 import requests
 import requests.auth
+import threading
 import time
 
+# default pace for bot calls until reddit's rate limit headers say otherwise
+RATE_PER_MINUTE = float(os.environ.get("REDDIT_RATE_PER_MINUTE", 60))
+RATE_BURST = int(os.environ.get("REDDIT_RATE_BURST", 10))
+
+
+class RedditError(Exception):
+    # raised when reddit can't be reached or rejects a request
+    pass
+
+
+class RedditClient(object):
+    # talks to reddit as the backend bot account. the bearer token is cached
+    # until shortly before it expires, and every call goes through one
+    # keep-alive session. base urls can be pointed at a local stub server.
+    # calls are paced by a token bucket that follows reddit's rate limits.
+
+    def __init__(self, auth_url=None, api_url=None, timeout=(5, 30),
+                 refresh_margin=60, limiter=None, max_retries=3):
+        self.auth_url = (auth_url or os.environ.get(
+            "REDDIT_AUTH_URL", "https://www.reddit.com")).rstrip("/")
+        self.api_url = (api_url or os.environ.get(
+            "REDDIT_API_URL", "https://oauth.reddit.com")).rstrip("/")
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.session = requests.Session()
+        self.limiter = limiter or TokenBucket(RATE_PER_MINUTE / 60, RATE_BURST)
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires = 0
+
+    @property
+    def user_agent(self):
+        return os.environ.get("REDDIT_USER_AGENT")
+
+    @timed("reddit.token")
+    def token(self):
+        # returns a bot bearer token, fetching a new one if needed. only one
+        # thread refreshes it; the others wait and reuse the result
+        if self._token and time.time() < self._expires:
+            return self._token
+        with self._lock:
+            if self._token and time.time() < self._expires:
+                return self._token
+            client_id = os.environ.get("REDDIT_BACKEND_CLIENT_ID")
+            client_secret = os.environ.get("REDDIT_BACKEND_CLIENT_SECRET")
+            client_auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
+            post_data = {"grant_type": "password",
+                         "username": os.environ.get("REDDIT_BACKEND_USERNAME"),
+                         "password": os.environ.get("REDDIT_BACKEND_PASSWORD")}
+            try:
+                response = self.session.post(
+                    self.auth_url + "/api/v1/access_token",
+                    auth=client_auth,
+                    data=post_data,
+                    headers={"User-Agent": self.user_agent},
+                    timeout=self.timeout)
+            except requests.RequestException as e:
+                reddit_responses.inc("token", "error")
+                raise RedditError(f"token request failed: {e}")
+            reddit_responses.inc("token", response.status_code)
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise RedditError(f"token request failed: {e}")
+            if "access_token" not in data:
+                raise RedditError(f"token request failed: {data}")
+            expires_in = data.get("expires_in", 3600)
+            self._token = data["access_token"]
+            self._expires = time.time() + max(expires_in - self.refresh_margin, 0)
+            return self._token
+
+    def invalidate_token(self):
+        with self._lock:
+            self._token = None
+            self._expires = 0
+
+    def request(self, function, method, path, **kwargs):
+        # makes an authenticated call to the oauth api on behalf of
+        # `function`, which labels its response metrics. a rejected token is
+        # refreshed and the call retried once, and a 429 waits for the rate
+        # limit window to reset before retrying
+        refreshed = False
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            headers = {"Authorization": "bearer " + self.token(),
+                       "User-Agent": self.user_agent}
+            try:
+                response = self.session.request(
+                    method, self.api_url + path, headers=headers,
+                    timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                reddit_responses.inc(function, "error")
+                raise RedditError(f"{method} {path} failed: {e}")
+            reddit_responses.inc(function, response.status_code)
+            self.limiter.observe(response)
+            if response.status_code == 401 and not refreshed:
+                self.invalidate_token()
+                refreshed = True
+                continue
+            if response.status_code == 429 and attempt < self.max_retries:
+                continue
+            if response.status_code == 429:
+                raise RedditError(f"{method} {path} was rate limited")
+            return response
+        # only reached when the last retry was spent refreshing the token
+        raise RedditError(f"{method} {path} failed after "
+                          f"{self.max_retries + 1} attempts")
+
+    @timed("reddit.submit_post")
+    def submit_post(self, title, text, subreddit):
+        parameters = {"api_type": "json",
+                      "kind": "self",
+                      "send_replies": False,
+                      "sr": subreddit,
+                      "text": text,
+                      "title": title}
+        response = self.request("submit_post", "POST", "/api/submit",
+                                data=parameters)
+        try:
+            url = response.json()['json']['data']['url']
+        except (KeyError, ValueError):
+            url = "error"
+        return url
+
+    @timed("reddit.post_comment")
+    def post_comment(self, thread, text):
+        # check for correct prefixing. assume thread unless stated otherwise.
+        acceptable_prefixes = ['t1_', 't3_', 't4_']
+        for prefix in acceptable_prefixes:
+            if thread.startswith(prefix):
+                break
+        else:
+            return
+
+        parameters = {"api_type": "json",
+                      "text": text,
+                      "parent": thread,
+                      }
+        response = self.request("post_comment", "POST", "/api/comment",
+                                data=parameters)
+        try:
+            # generate URL for message/comment
+            response_json = response.json()['json']['data']['things'][0]['data']
+            base_url_comment = "https://www.reddit.com/r/{0}/comments/{1}/_/{2}"
+            base_url_message = "https://www.reddit.com/message/messages/{0}"
+            subreddit = response_json['subreddit']
+            if subreddit:
+                exp = re.compile("(t1|t3)_(.+)")
+                parent = exp.search(thread).groups()[1]
+            thread = response_json['id']
+            if subreddit:
+                url = base_url_comment.format(subreddit, parent, thread)
+            else:
+                url = base_url_message.format(thread)
+        except (KeyError, IndexError, ValueError):
+            url = response.json()
+        return url
+
+    @timed("reddit.user_info")
+    def user_info(self, username):
+        out = self.request("user_info", "GET", f"/user/{username}/about.json")
+        try:
+            me_dict = out.json()['data']
+        except (KeyError, ValueError):
+            return out.json()
+        try:
+            combined = int(me_dict['comment_karma']) + int(me_dict['link_karma'])
+            return {'name': me_dict['name'],
+                    'created': me_dict['created'],
+                    'link_karma': me_dict['link_karma'],
+                    'comment_karma': me_dict['comment_karma'],
+                    'combined_karma': combined,
+                    'is_mod': me_dict['is_mod'],
+                    'is_gold': me_dict['is_gold'],
+                    'has_verified_email': me_dict['has_verified_email']}
+        except KeyError:
+            return {'name': me_dict.get('name'),
+                    'is_suspended': me_dict.get('is_suspended')}
+
+    @timed("reddit.send_message")
+    def send_message(self, user, subject, message):
+        parameters = {"api_type": "json",
+                      "subject": subject,
+                      "text": message,
+                      "to": user}
+        response = self.request("send_message", "POST", "/api/compose",
+                                data=parameters)
+        if response.status_code != 200:
+            raise RedditError(f"compose failed with status {response.status_code}")
+        try:
+            errors = response.json()['json']['errors']
+        except (KeyError, ValueError):
+            errors = []
+        if errors:
+            raise RedditError(f"compose failed: {errors}")
+        return "success"
+
+    @timed("reddit.verify_identity")
+    def verify_identity(self, code):
+        # exchanges a user's oauth code for their account info
+        headers = {"User-Agent": self.user_agent}
+        client_id = os.environ.get('REDDIT_FRONTEND_CLIENT_ID')
+        client_secret = os.environ.get('REDDIT_FRONTEND_CLIENT_SECRET')
+        auth = (client_id, client_secret)
+        params = {"grant_type": "authorization_code",
+                  "code": code,
+                  "redirect_uri": os.environ.get('REDDIT_FRONTEND_REDIRECT_URI')}
+        result = self.session.post(
+            self.auth_url + "/api/v1/access_token",
+            headers=headers,
+            auth=auth,
+            params=params,
+            timeout=self.timeout)
+        reddit_responses.inc("verify_identity", result.status_code)
+
+        auth_dict = result.json()
+        if 'error' in auth_dict:
+            return None
+
+        headers = {"User-Agent": self.user_agent,
+                   "Authorization": f"bearer {auth_dict['access_token']}"}
+        user_page = self.session.get(self.api_url + "/api/v1/me",
+                                     headers=headers,
+                                     timeout=self.timeout)
+        reddit_responses.inc("verify_identity", user_page.status_code)
+        me_dict = user_page.json()
+
+        return {'name': me_dict['name'],
+                'created': me_dict['created'],
+                'link_karma': me_dict['link_karma'],
+                'comment_karma': me_dict['comment_karma'],
+                'combined_karma': (int(me_dict['comment_karma']) + int(me_dict['link_karma'])),
+                'is_mod': me_dict['is_mod'],
+                'is_gold': me_dict['is_gold'],
+                'has_verified_email': me_dict['has_verified_email']}
+
+
+# shared by every request handled in this process
+client = RedditClient()
+
 
 def verify_identity(code):
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
-    headers = {"User-Agent": user_agent}
-    client_id = os.environ.get('REDDIT_FRONTEND_CLIENT_ID')
-    client_secret = os.environ.get('REDDIT_FRONTEND_CLIENT_SECRET')
-    auth = (client_id, client_secret)
-    params = {"grant_type": "authorization_code",
-              "code": code,
-              "redirect_uri": os.environ.get('REDDIT_FRONTEND_REDIRECT_URI')}
-    result = requests.post(
-    "https://www.reddit.com/api/v1/access_token",
-    headers=headers,
-    auth=auth,
-     params=params)
-
-    auth_dict = result.json()
-    if 'error' in auth_dict:
-        return None
-
-    headers = {"User-Agent": user_agent,
-               "Authorization": f"bearer {auth_dict['access_token']}"}
-    user_page = requests.get("https://oauth.reddit.com/api/v1/me",
-                             headers=headers)
-    me_dict = user_page.json()
-
-    return {'name': me_dict['name'],
-            'created': me_dict['created'],
-            'link_karma': me_dict['link_karma'],
-            'comment_karma': me_dict['comment_karma'],
-            'combined_karma': (int(me_dict['comment_karma']) + int(me_dict['link_karma'])),
-            'is_mod': me_dict['is_mod'],
-            'is_gold': me_dict['is_gold'],
-            'has_verified_email': me_dict['has_verified_email']}
+    return client.verify_identity(code)
 
 
 def generate_oauth_url(state, next_path='form', scopes=["identity"]):
     # generates a OAuth URL for reddit
-    base = "https://www.reddit.com/api/v1/authorize?"
+    base = client.auth_url + "/api/v1/authorize?"
     params = {"client_id": os.environ.get('REDDIT_FRONTEND_CLIENT_ID'),
               "response_type": "code",
               "state": state + "|" + next_path,
@@ -54,132 +267,43 @@ def generate_oauth_url(state, next_path='form', scopes=["identity"]):
 
 
 def get_bot_auth():
-    # Creates a bot authorization token
-    client_id = os.environ.get("REDDIT_BACKEND_CLIENT_ID")
-    client_secret = os.environ.get("REDDIT_BACKEND_CLIENT_SECRET")
-    username = os.environ.get("REDDIT_BACKEND_USERNAME")
-    password = os.environ.get("REDDIT_BACKEND_PASSWORD")
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
-
-    client_auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
-    post_data = {"grant_type": "password",
-                 "username": username,
-                 "password": password}
-    headers = {"User-Agent": user_agent}
-    response = requests.post("https://www.reddit.com/api/v1/access_token",
-                             auth=client_auth,
-                             data=post_data,
-                             headers=headers)
-    return response.json()['access_token']
+    # returns the cached bot authorization token
+    return client.token()
 
 
 def submit_post(title, text, subreddit):
-    bearer = "bearer " + get_bot_auth()
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
-    headers = {"Authorization": bearer, "User-Agent": user_agent}
-    parameters = {"api_type": "json",
-                  "kind": "self",
-                  "send_replies": False,
-                  "sr": subreddit,
-                  "text": text,
-                  "title": title}
-    response = requests.post("https://oauth.reddit.com/api/submit",
-                             headers=headers,
-                             data=parameters)
-    try:
-        url = response.json()['json']['data']['url']
-    except KeyError:
-        url = "error"
-    return url
+    return client.submit_post(title, text, subreddit)
 
 
 def post_comment(thread, text):
-    bearer = "bearer " + get_bot_auth()
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
-    headers = {"Authorization": bearer, "User-Agent": user_agent}
-
-    # check for correct prefixing. assume thread unless stated otherwise.
-    acceptable_prefixes = ['t1_', 't3_', 't4_']
-    for prefix in acceptable_prefixes:
-        if thread.startswith(prefix):
-            break
-    else:
-        return
-
-    parameters = {"api_type": "json",
-                  "text": text,
-                  "parent": thread,
-                 }
-    response = requests.post("https://oauth.reddit.com/api/comment",
-                             headers=headers,
-                             data=parameters)
-    try:
-        # generate URL for message/comment
-        response_json = response.json()['json']['data']['things'][0]['data']
-        base_url_comment = "https://www.reddit.com/r/{0}/comments/{1}/_/{2}"
-        base_url_message = "https://www.reddit.com/message/messages/{0}"
-        subreddit = response_json['subreddit']
-        if subreddit:
-            exp = re.compile("(t1|t3)_(.+)")
-            parent = exp.search(thread).groups()[1]
-        thread = response_json['id']
-        if subreddit:
-            url = base_url_comment.format(subreddit, parent, thread)
-        else:
-            url = base_url_message.format(thread)
-    except KeyError:
-        url = response.json()
-    return url
+    return client.post_comment(thread, text)
+
 
 def user_info(username):
-    bearer = "bearer " + get_bot_auth()
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
-    headers = {"Authorization" : bearer, "User-Agent" : user_agent}
-    out = requests.get("https://oauth.reddit.com/user/{0}/about.json".format(username), headers=headers)
+    return client.user_info(username)
 
-    combined = int(me_dict['comment_karma']) + int(me_dict['link_karma'])
-    try:
-        me_dict =  out.json()['data']
-        reg_dict_out = {'name': me_dict['name'],
-                        'created': me_dict['created'],
-                        'link_karma': me_dict['link_karma'],
-                        'comment_karma': me_dict['comment_karma'],
-                        'combined_karma': combined,
-                        'is_mod': me_dict['is_mod'],
-                        'is_gold': me_dict['is_gold'],
-                        'has_verified_email': me_dict['has_verified_email']}
-        return reg_dict_out
-    except:
-        try:
-            me_dict =  out.json()['data']
-            susp_dict_out = {'name': me_dict['name'],
-                             'is_suspended': me_dict['is_suspended']}
-            return susp_dict_out
-        except:
-            return out.json()
 
 def send_message(user, subject, message):
-    user_agent = os.environ.get("REDDIT_USER_AGENT")
     try:
-        bearer = "bearer " + get_bot_auth()
-        headers = {"Authorization": bearer, "User-Agent": user_agent}
-        parameters = {"api_type": "json",
-                      "subject": subject,
-                      "text": message,
-                      "to": user}
-        response = requests.post("https://oauth.reddit.com/api/compose", headers=headers, data=parameters)
-        return "success"
-    except:
+        return client.send_message(user, subject, message)
+    except RedditError:
         return "failure"
 
 
 def route(title, body, destination):
+    # delivers a form submission to its destination. raises RedditError if
+    # reddit didn't accept it, and returns a link (or "success") otherwise
     if destination.startswith('t1_') or destination.startswith(
-        't3_') or destination.startswith('t4_'):
-        return post_comment(destination, body)
+            't3_') or destination.startswith('t4_'):
+        result = client.post_comment(destination, body)
+        if not isinstance(result, str):
+            raise RedditError(f"comment failed: {result}")
     elif 'r/' in destination:
         exp = re.compile(r"\/?r\/(.+)")
         sr_name = exp.findall(destination)[0]
-        submit_post(title, body, sr_name)
+        result = client.submit_post(title, body, sr_name)
+        if result == "error":
+            raise RedditError("submission failed")
     else:
-        send_message(destination, title, body)
+        result = client.send_message(destination, title, body)
+    return result
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+from markupsafe import escape
+from metrics import timed
+import hashlib
+import markdown
+import os
+import threading
+
+# rendered html kept per process, by content hash
+CACHE_SIZE = int(os.environ.get("MARKDOWN_CACHE_SIZE", 256))
+# optional directory to keep rendered html across restarts
+CACHE_DIR = os.environ.get("MARKDOWN_CACHE_DIR")
+# bigger bodies are shown as preformatted text instead of parsed
+MAX_CHARS = int(os.environ.get("MARKDOWN_MAX_CHARS", 200000))
+
+_local = threading.local()
+_lock = threading.Lock()
+_cache = OrderedDict()
+
+
+def _markdown():
+    # Markdown instances aren't thread-safe, so each thread keeps its own
+    md = getattr(_local, "md", None)
+    if md is None:
+        md = _local.md = markdown.Markdown()
+    return md
+
+
+def _convert(text):
+    if len(text) > MAX_CHARS:
+        return f"<pre>{escape(text)}</pre>"
+    md = _markdown()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+
+@timed("render_html")
+def render_html(text):
+    # renders a submission's markdown, reusing earlier renders of the same
+    # text
+    if not text:
+        return ""
+    key = hashlib.sha256(text.encode()).hexdigest()
+    with _lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    html = None
+    path = os.path.join(CACHE_DIR, key + ".html") if CACHE_DIR else None
+    if path and os.path.exists(path):
+        with open(path, "r") as f:
+            html = f.read()
+    if html is None:
+        html = _convert(text)
+        if path:
+            # write then rename so readers never see a partial file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "w") as f:
+                f.write(html)
+            os.replace(tmp, path)
+
+    with _lock:
+        _cache[key] = html
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return html
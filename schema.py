@@ -0,0 +1,151 @@
+from flask import current_app
+from functools import lru_cache
+from models import db, QuestionSet
+from validation import compile_checks, resolve
+import base64
+import hashlib
+import hmac
+import json
+
+# requirement descriptions shown under each question, by validator and type
+VALIDATOR_WORDS = {
+    ("min", "text"): "Must be longer than {} characters",
+    ("min", "textarea"): "Must be longer than {} characters",
+    ("min", "number"): "Number must be bigger than {}.",
+    ("min", "checkbox"): "At least {} need to be selected",
+    ("max", "text"): "Must be shorter than {} characters",
+    ("max", "textarea"): "Must be shorter than {} characters",
+    ("max", "number"): "Number must be smaller than {}.",
+    ("max", "checkbox"): "No more than {} may be selected",
+}
+
+
+class Question(object):
+    # a single question from a QuestionSet, with everything that can be
+    # worked out ahead of time
+
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+        self.text = data["text"]
+        self.type = data["type"].lower()
+        self.validators = data.get("validators", {})
+        self.options = list(data.get("data", []))
+        self.validator_words = describe_validators(self.type, self.validators)
+        self.checks = compile_checks(self.type, self.validators)
+
+
+class FormSchema(object):
+    # the parsed questions of one QuestionSet
+
+    def __init__(self, questions_json, version=None):
+        self.version = version
+        self.questions = [Question(i, q)
+                          for i, q in enumerate(json.loads(questions_json))]
+        # one field per question plus one per option, in order. a field's
+        # position is public; the signature after it ties it to a user
+        self.fields = []
+        for q in self.questions:
+            self.fields.append((q.index, None))
+            for j in range(len(q.options)):
+                self.fields.append((q.index, j))
+        # preview questions have blank ids and no responses
+        self.preview = self.render([""] * len(self.fields))
+        for q in self.preview:
+            q["response"] = None
+
+    def ids_for(self, user_id):
+        # field ids for one user: "f<position>-<signature>", where the
+        # signature is a keyed hash of (user, version, question, option)
+        return [f"f{p}-{self._sign(user_id, qi, oi)}"
+                for p, (qi, oi) in enumerate(self.fields)]
+
+    def _sign(self, user_id, qi, oi):
+        msg = f"{user_id}:{self.version}:{qi}:{'' if oi is None else oi}"
+        key = (current_app.secret_key or "").encode()
+        digest = hmac.new(key, msg.encode(), hashlib.sha256).digest()
+        return base64.b32encode(digest[:5]).decode().lower()
+
+    def _lookup(self, user_id, field_id):
+        # returns the (question, option) a field id stands for, or None if
+        # it's malformed or wasn't issued to this user
+        try:
+            position, sig = field_id[1:].split("-", 1)
+            qi, oi = self.fields[int(position)]
+        except (ValueError, IndexError):
+            return None
+        if not hmac.compare_digest(sig, self._sign(user_id, qi, oi)):
+            return None
+        return qi, oi
+
+    def render(self, ids, answers=None, errors=None):
+        # builds the question list form.html expects from a user's field ids
+        # and answers
+        ids = iter(ids)
+        out = []
+        for q in self.questions:
+            d = dict(q.data)
+            d["id"] = next(ids)
+            if q.options:
+                d["data"] = [[next(ids), option] for option in q.options]
+            if q.validator_words:
+                d["validator_words"] = q.validator_words
+            answer = answers[q.index] if answers else None
+            resp = resolve(q, answer)
+            d["response"] = "" if resp is None else resp
+            if errors and q.index in errors:
+                d["error"] = errors[q.index]
+            out.append(d)
+        return out
+
+    def decode(self, user_id, form):
+        # maps submitted fields back to question indexes. `form` yields
+        # (name, values) pairs; choice questions submit option ids, which
+        # come back as option indexes
+        raw = {}
+        for name, values in form:
+            field = self._lookup(user_id, name)
+            if field is None or field[1] is not None:
+                continue
+            index = field[0]
+            if self.questions[index].options:
+                options = [self._lookup(user_id, v) for v in values]
+                values = [o[1] for o in options
+                          if o is not None and o[0] == index and o[1] is not None]
+            raw[index] = values
+        return raw
+
+    def responses(self, answers):
+        # the answers as shown to the user, indexed by question
+        return [resolve(q, a) for q, a in zip(self.questions, answers)]
+
+
+def describe_validators(q_type, validators):
+    words = []
+    for validator, value in validators.items():
+        validator = validator.lower()
+        if validator == "required":
+            if value:
+                words.append("Requires a response.")
+        elif (validator, q_type) in VALIDATOR_WORDS:
+            words.append(VALIDATOR_WORDS[(validator, q_type)].format(value))
+    return words
+
+
+@lru_cache(maxsize=16)
+def get_schema(question_set_id):
+    # returns the compiled schema for a QuestionSet. question sets never
+    # change, so each one is compiled once per process
+    question_set = QuestionSet.query.get(question_set_id)
+    return FormSchema(question_set.questions, question_set_id)
+
+
+def publish(settings, questions_json):
+    # saves questions as a new QuestionSet and makes it the live form.
+    # settings must be attached to the session; the caller commits
+    question_set = QuestionSet(questions=questions_json)
+    db.session.add(question_set)
+    db.session.flush()
+    settings.questions = questions_json
+    settings.question_set_id = question_set.id
+    return question_set
@@ -0,0 +1,177 @@
+# table-driven validation for form submissions. nothing in here touches the
+# request, so stored responses can be re-checked in bulk (e.g. after the
+# validators change) with validate(schema, responses).
+
+
+class ParseError(ValueError):
+    # raised when a submitted value can't be read as its question type
+    pass
+
+
+def _too_short_text(resp, limit):
+    if resp is not None and len(resp) < limit:
+        return f"Response was too short. Minimum length is {limit} characters."
+
+
+def _too_long_text(resp, limit):
+    if resp is not None and len(resp) > limit:
+        return f"Response was too long. Maximum length is {limit} characters."
+
+
+def _too_small_number(resp, limit):
+    if resp is not None and resp < limit:
+        return f"Response was too small. Number must be greater than {limit}."
+
+
+def _too_large_number(resp, limit):
+    if resp is not None and resp > limit:
+        return f"Response was too large. Number must be smaller than {limit}."
+
+
+def _too_few_checked(resp, limit):
+    if len(resp) < limit:
+        return f"Response was too short. At least {limit} checkboxes must be checked."
+
+
+def _too_many_checked(resp, limit):
+    if len(resp) > limit:
+        return f"Response was too long. No more than {limit} checkboxes may be checked."
+
+
+def _missing(resp, limit):
+    if limit and (resp is None or resp == "" or resp == []):
+        return "A reply to this question is required."
+
+
+# (question type, validator) -> check(response, validator value)
+CHECKS = {
+    ("text", "min"): _too_short_text,
+    ("textarea", "min"): _too_short_text,
+    ("radio", "min"): _too_short_text,
+    ("number", "min"): _too_small_number,
+    ("checkbox", "min"): _too_few_checked,
+    ("text", "max"): _too_long_text,
+    ("textarea", "max"): _too_long_text,
+    ("radio", "max"): _too_long_text,
+    ("number", "max"): _too_large_number,
+    ("checkbox", "max"): _too_many_checked,
+}
+for _type in ["text", "textarea", "number", "radio", "checkbox", "dropdown"]:
+    CHECKS[(_type, "required")] = _missing
+
+# checks are run in this order so errors come out the same way every time
+ORDER = ["min", "max", "required"]
+
+
+def compile_checks(q_type, validators):
+    # returns the (check, value) pairs that apply to a question
+    checks = []
+    for name in ORDER:
+        if name in validators and (q_type, name) in CHECKS:
+            checks.append((CHECKS[(q_type, name)], validators[name]))
+    return checks
+
+
+def _parse_text(question, values):
+    return values[0] if values else None
+
+
+def _parse_number(question, values):
+    if not values or values[0] in ("", None):
+        return None
+    try:
+        return int(values[0])
+    except (TypeError, ValueError):
+        raise ParseError("Response must be a whole number.")
+
+
+def _parse_choice(question, values):
+    # values are option indexes
+    for value in values:
+        index = _option(question, value)
+        if index is not None:
+            return index
+    return None
+
+
+def _parse_choices(question, values):
+    out = []
+    for value in values:
+        index = _option(question, value)
+        if index is not None:
+            out.append(index)
+    return out
+
+
+def _option(question, value):
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+    if 0 <= index < len(question.options):
+        return index
+    return None
+
+
+PARSERS = {
+    "text": _parse_text,
+    "textarea": _parse_text,
+    "number": _parse_number,
+    "radio": _parse_choice,
+    "dropdown": _parse_choice,
+    "checkbox": _parse_choices,
+}
+
+
+def resolve(question, answer):
+    # turns a stored answer into what the user sees: option labels for
+    # choice questions, the answer itself otherwise
+    if question.type == "checkbox":
+        return [question.options[i] for i in (answer or [])]
+    if question.type in ["radio", "dropdown"]:
+        if answer is None:
+            return "" if question.type == "radio" else None
+        return question.options[answer]
+    return answer
+
+
+def check(question, answer):
+    # returns the error messages for one stored answer
+    resp = resolve(question, answer)
+    errors = []
+    for func, limit in question.checks:
+        msg = func(resp, limit)
+        if msg:
+            errors.append(msg)
+    return errors
+
+
+def parse_and_validate(schema, raw):
+    # raw maps question index -> list of submitted values, where choice
+    # questions submit option indexes. returns (answers, errors): answers is
+    # a list indexed by question, holding option indexes for choice
+    # questions, and errors maps question index -> messages.
+    answers = []
+    errors = {}
+    for q in schema.questions:
+        try:
+            answer = PARSERS[q.type](q, raw.get(q.index, []))
+        except ParseError as e:
+            answers.append(None)
+            errors[q.index] = [str(e)]
+            continue
+        answers.append(answer)
+        q_errors = check(q, answer)
+        if q_errors:
+            errors[q.index] = q_errors
+    return answers, errors
+
+
+def validate(schema, answers):
+    # re-checks stored answers, e.g. the ones saved on User rows
+    errors = {}
+    for q, answer in zip(schema.questions, answers):
+        q_errors = check(q, answer)
+        if q_errors:
+            errors[q.index] = q_errors
+    return errors